@@ -1,125 +1,806 @@
 import os
+import json
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 import pandas as pd
-from multiprocessing import Pool
-from scipy.sparse.csgraph import minimum_spanning_tree
+from multiprocessing import Pool, shared_memory
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components
+from scipy.spatial.distance import squareform
 import click
 import networkx as nx
 import plotly.graph_objects as go
 import plotly.express as px
+from plotly.offline import get_plotlyjs
 
 # ---------- CORE DISTANCE FUNCTIONS ----------
 
+# Upper bound (in bytes) for the boolean comparison block built by calculate_distance.
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+# arrays of a distance context that pool workers attach to in shared memory
+SHARED_CONTEXT_ARRAYS = ("alleles", "presence", "present_counts")
+
+
+def _distance_context(mat: np.ndarray, allowed_missing: float) -> dict:
+    """Per-profile quantities reused by every distance block."""
+    return {
+        "alleles": mat,
+        # float32 is exact for locus counts below 2**24 and halves the matmul input
+        "presence": (mat > 0).astype(np.float32),
+        "present_counts": np.count_nonzero(mat, axis=1),
+        "min_missing": allowed_missing * mat.shape[1],
+    }
+
+
+def _corrected_distance(shared: np.ndarray, matches: np.ndarray, rows_present: np.ndarray,
+                        cols_present: np.ndarray, min_missing: float, n_loci: int) -> np.ndarray:
+    """Apply the missing-loci correction (pHierCC) to shared/matching locus counts and round to int16."""
+    al = 1e-4 + shared
+    ad = 1e-4 + (shared - matches)
+
+    ll = np.maximum(rows_present, cols_present) - min_missing
+    too_many_missing = ll > al
+    ad = np.where(too_many_missing, ad + (ll - al), ad)
+    al = np.where(too_many_missing, ll, al)
+
+    return (ad / al * n_loci + 0.5).astype(np.int16)
+
+
+def _distance_block(context: dict, rows: np.ndarray, col_start: int = 0) -> np.ndarray:
+    """
+    Distances between the profiles listed in rows and profiles [col_start, N).
+
+    Rows are processed in blocks: shared loci come from a matrix product of the
+    presence masks, identical alleles from a broadcast comparison of the block
+    against the profiles. The missing-loci correction and int16 rounding follow
+    the pairwise formula exactly, so results are identical to a per-pair loop.
+    """
+    alleles, presence = context["alleles"], context["presence"]
+    present_counts = context["present_counts"]
+    n_samples, n_loci = alleles.shape
+    columns = alleles[col_start:]
+
+    distance_matrix = np.zeros((len(rows), n_samples - col_start), dtype=np.int16)
+    block_size = max(1, BLOCK_BYTES // max(1, columns.size))
+
+    for block_start in range(0, len(rows), block_size):
+        block_rows = rows[block_start:block_start + block_size]
+        block = alleles[block_rows]
+
+        shared = (presence[block_rows] @ presence[col_start:].T).astype(np.float64)
+        matches = np.count_nonzero(
+            (block[:, None, :] == columns[None, :, :]) & (block > 0)[:, None, :],
+            axis=2
+        )
+        distance_matrix[block_start:block_start + len(block_rows), :] = _corrected_distance(
+            shared, matches, present_counts[block_rows, None], present_counts[None, col_start:],
+            context["min_missing"], n_loci
+        )
+
+    return distance_matrix
+
+
+def self_distances(mat: np.ndarray, allowed_missing: float = 0.05) -> np.ndarray:
+    """
+    Distance of every profile to itself, i.e. the diagonal of the square matrix.
+    It is 0 except for profiles with (almost) no called loci.
+    """
+    present_counts = (mat > 0).sum(axis=1)
+    shared = present_counts.astype(np.float64)
+    return _corrected_distance(shared, present_counts, present_counts, present_counts,
+                               allowed_missing * mat.shape[1], mat.shape[1])
+
+
+def calculate_distance_rows(mat: np.ndarray, rows: np.ndarray, allowed_missing: float = 0.05) -> np.ndarray:
+    """
+    Calculate the allelic distances between the profiles listed in rows and all profiles.
+    mat is an integer allele matrix (profiles x loci) with 0 marking a missing allele.
+    """
+    return _distance_block(_distance_context(mat, allowed_missing), np.asarray(rows, dtype=np.int64))
+
+
 def calculate_distance(mat: np.ndarray, start_row: int, end_row: int, allowed_missing: float = 0.05) -> np.ndarray:
     """Calculate a fragment of the allelic distance matrix for rows [start_row, end_row)."""
-    n_loci = mat.shape[1] - 1
-    distance_matrix = np.zeros(((end_row - start_row), mat.shape[0]), dtype=np.int16)
+    return calculate_distance_rows(mat, np.arange(start_row, end_row), allowed_missing)
 
-    for i in range(start_row, end_row):
-        out_index_row = i - start_row
-        wektor_x = mat[i, 1:]
-        ql = np.sum(wektor_x > 0)
 
-        for j in range(mat.shape[0]):
-            wektor_y = mat[j, 1:]
-            rl = np.sum(wektor_y > 0)
-            shared_nonzero = (wektor_x > 0) & (wektor_y > 0)
+# ---------- CONDENSED STORAGE ----------
 
-            al = 1e-4 + np.sum(shared_nonzero)
-            ad = 1e-4 + np.sum(wektor_x[shared_nonzero] != wektor_y[shared_nonzero])
+def condensed_offset(n_samples: int, row: int | np.ndarray) -> int | np.ndarray:
+    """Position of pair (row, row + 1) in the SciPy-style condensed vector of an N×N matrix."""
+    return row * n_samples - row * (row + 1) // 2
 
-            ll = max(ql, rl) - allowed_missing * n_loci
-            if ll > al:
-                ad += ll - al
-                al = ll
 
-            distance_matrix[out_index_row, j] = np.int16(ad / al * n_loci + 0.5)
+def condensed_row(condensed: np.ndarray, n_samples: int, row: int) -> np.ndarray:
+    """Distances of one profile to all profiles (0 for itself), read from a condensed vector."""
+    out = np.zeros(n_samples, dtype=condensed.dtype)
+    before = np.arange(row)
+    out[:row] = condensed[condensed_offset(n_samples, before) + row - before - 1]
+    out[row + 1:] = condensed[condensed_offset(n_samples, row):condensed_offset(n_samples, row + 1)]
+    return out
+
+
+def squareform_distances(condensed: np.ndarray, diagonal: np.ndarray | None = None) -> np.ndarray:
+    """Expand a condensed distance vector into the square matrix, optionally with a non-zero diagonal."""
+    square = squareform(condensed, checks=False)
+    if diagonal is not None:
+        np.fill_diagonal(square, diagonal)
+    return square
+
+
+# ---------- PARALLEL SCHEDULING ----------
+
+# Number of tasks per worker; more tasks than workers smooths out uneven task durations.
+TASKS_PER_WORKER = 4
+
+_worker_state = {}
+
+
+def _triangular_splits(n_samples: int, n_tasks: int) -> list[tuple[int, int]]:
+    """
+    Split rows [0, N) into contiguous ranges holding roughly the same number of
+    upper-triangle cells; row i contributes N - i cells.
+    """
+    work = np.cumsum(np.arange(n_samples, 0, -1, dtype=np.int64))
+    targets = work[-1] * np.arange(1, n_tasks) / n_tasks
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(work, targets) + 1, [n_samples]]))
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _fill_condensed(context: dict, out: np.ndarray, task: tuple[int, int]) -> None:
+    """Compute pairs i < j for rows [start, end); they form one contiguous slice of the condensed vector."""
+    start, end = task
+    n_samples = context["alleles"].shape[0]
+    block = _distance_block(context, np.arange(start, end), col_start=start)
+    upper = np.triu(np.ones(block.shape, dtype=bool), 1)
+    out[condensed_offset(n_samples, start):condensed_offset(n_samples, end)] = block[upper]
+
+
+def _fill_rows(context: dict, out: np.ndarray, task: tuple[int, int, np.ndarray]) -> None:
+    """Compute full rows for the given profiles into out[out_start:out_end]."""
+    out_start, out_end, rows = task
+    out[out_start:out_end] = _distance_block(context, rows)
+
+
+def _to_shared(array: np.ndarray) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, shared
 
-    return distance_matrix
 
+def _init_distance_worker(specs: dict[str, tuple], min_missing: float, fill) -> None:
+    """Attach a pool worker to the shared context arrays (SHARED_CONTEXT_ARRAYS) and the output array."""
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_state[f"{key}_shm"] = shm
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker_state["out"] = arrays.pop("out")
+    _worker_state["context"] = {**arrays, "min_missing": min_missing}
+    _worker_state["fill"] = fill
 
-def calculte_distance_matrix(mat: np.ndarray, cpus: int = 1, allowed_missing: float = 0.05) -> np.ndarray:
-    """Compute the full N×N allelic distance matrix for a given profile matrix."""
+
+def _run_worker_task(task: tuple) -> None:
+    _worker_state["fill"](_worker_state["context"], _worker_state["out"], task)
+
+
+def _run_distance_tasks(mat: np.ndarray, out_shape: tuple, fill, tasks: list[tuple],
+                        cpus: int, allowed_missing: float) -> np.ndarray:
+    """
+    Run distance tasks writing into an int16 output array of out_shape.
+    With several CPUs the context arrays (built once, here) and the output array live
+    in shared memory and every worker writes its part in place, so only task
+    descriptions cross the pipe.
+    """
+    context = _distance_context(mat, allowed_missing)
+    if cpus == 1:
+        out = np.zeros(out_shape, dtype=np.int16)
+        for task in tasks:
+            fill(context, out, task)
+        return out
+
+    shared = {key: _to_shared(np.ascontiguousarray(context.pop(key))) for key in SHARED_CONTEXT_ARRAYS}
+    shared["out"] = _to_shared(np.zeros(out_shape, dtype=np.int16))
+    try:
+        specs = {key: (shm.name, array.shape, array.dtype) for key, (shm, array) in shared.items()}
+        with Pool(cpus, initializer=_init_distance_worker,
+                  initargs=(specs, context["min_missing"], fill)) as pool:
+            for _ in pool.imap_unordered(_run_worker_task, tasks):
+                pass
+        return shared["out"][1].copy()
+    finally:
+        # the arrays must be released before their buffers can be closed
+        segments = [shm for shm, _ in shared.values()]
+        shared.clear()
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def calculate_condensed_distances(mat: np.ndarray, cpus: int = 1, allowed_missing: float = 0.05) -> np.ndarray:
+    """
+    Compute allelic distances for all pairs i < j in SciPy-style condensed form
+    (length N·(N-1)/2, int16). Rows are split into tasks of equal upper-triangle work.
+    """
     n_samples = mat.shape[0]
-    distance_matrix = np.zeros((n_samples, n_samples), dtype=np.int16)
-    row_splits = np.array_split(np.arange(n_samples), cpus)
-
-    with Pool(cpus) as pool:
-        jobs = [
-            pool.apply_async(calculate_distance, (mat, rows[0], rows[-1] + 1, allowed_missing))
-            for rows in row_splits
-        ]
-        start = 0
-        for job in jobs:
-            partial_matrix = job.get()
-            end = start + partial_matrix.shape[0]
-            distance_matrix[start:end, :] = partial_matrix
-            start = end
+    n_tasks = max(1, min(n_samples, cpus * TASKS_PER_WORKER))
+    tasks = _triangular_splits(n_samples, n_tasks)
+    return _run_distance_tasks(mat, (n_samples * (n_samples - 1) // 2,), _fill_condensed,
+                               tasks, cpus, allowed_missing)
 
-    return distance_matrix
 
+def calculte_distance_matrix(mat: np.ndarray, cpus: int = 1, allowed_missing: float = 0.05,
+                             rows: np.ndarray | None = None) -> np.ndarray:
+    """
+    Compute the allelic distance matrix for a given profile matrix.
+    By default the full N×N matrix is returned (expanded from the condensed form);
+    with rows only those rows (len(rows)×N) are computed.
+    """
+    if rows is None:
+        return squareform_distances(calculate_condensed_distances(mat, cpus, allowed_missing),
+                                    self_distances(mat, allowed_missing))
+
+    rows = np.asarray(rows, dtype=np.int64)
+    n_tasks = max(1, min(len(rows), cpus * TASKS_PER_WORKER))
+    bounds = np.linspace(0, len(rows), n_tasks + 1).astype(int)
+    tasks = [(a, b, rows[a:b]) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    return _run_distance_tasks(mat, (len(rows), mat.shape[0]), _fill_rows, tasks, cpus, allowed_missing)
 
-def calculate_mst(distance_matrix: np.ndarray, labels: list[str]) -> np.ndarray:
-    """Compute the Minimum Spanning Tree (MST) from the allelic distance matrix."""
-    mat = np.triu(distance_matrix, 1)
-    mst = minimum_spanning_tree(mat).toarray().astype(int)
-    edges = [(labels[i], labels[j], int(mst[i, j]))
-             for i in range(mst.shape[0]) for j in range(mst.shape[1]) if mst[i, j] > 0]
+
+# ---------- INCREMENTAL UPDATES ----------
+
+def profile_digests(mat: np.ndarray, labels: list[str]) -> dict[str, str]:
+    """Short content digest of every allele profile, keyed by ST id."""
+    return {label: hashlib.blake2b(np.ascontiguousarray(row, dtype="<u4").tobytes(), digest_size=8).hexdigest()
+            for label, row in zip(labels, mat)}
+
+
+def digests_path(matrix_path: str) -> str:
+    """Path of the profile digests written next to a distance matrix TSV."""
+    return f"{matrix_path}.profiles.json"
+
+
+def write_profile_digests(matrix_path: str, mat: np.ndarray, labels: list[str], allowed_missing: float) -> None:
+    """Record the profiles a distance matrix was computed from, so a later run can reuse it."""
+    with open(digests_path(matrix_path), "w") as f:
+        json.dump({"allowed_missing": allowed_missing,
+                   "n_loci": int(mat.shape[1]),
+                   "profiles": profile_digests(mat, labels)}, f)
+
+
+def update_distance_matrix(mat: np.ndarray, labels: list[str], previous_matrix: str,
+                           cpus: int = 1, allowed_missing: float = 0.05) -> np.ndarray:
+    """
+    Build the condensed distance vector reusing a matrix written by a previous run (--output).
+    Distances between STs present in the previous matrix are copied, provided their profiles
+    (checked against the digests stored next to the matrix) and the missing-loci setting
+    are unchanged. Only rows of new or changed STs are computed.
+    """
+    n_samples = mat.shape[0]
+    try:
+        with open(digests_path(previous_matrix)) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        click.echo(f"⚠️ No profile digests found for {previous_matrix}; computing the full matrix.")
+        return calculate_condensed_distances(mat, cpus=cpus, allowed_missing=allowed_missing)
+    if previous["allowed_missing"] != allowed_missing or previous["n_loci"] != mat.shape[1]:
+        click.echo(f"⚠️ {previous_matrix} was computed with different settings; computing the full matrix.")
+        return calculate_condensed_distances(mat, cpus=cpus, allowed_missing=allowed_missing)
+
+    # ST labels are read as strings and distances as int16, not as one Python string per cell
+    header = pd.read_csv(previous_matrix, sep="\t", nrows=0).columns
+    previous_df = pd.read_csv(previous_matrix, sep="\t", index_col=0,
+                              dtype={column: (str if i == 0 else np.int16) for i, column in enumerate(header)})
+    previous_position = {st: i for i, st in enumerate(previous_df.index)}
+    current_digests = profile_digests(mat, labels)
+
+    reused = np.array([i for i, st in enumerate(labels)
+                       if st in previous_position and previous["profiles"].get(st) == current_digests[st]],
+                      dtype=np.int64)
+    changed = [st for st in labels if st in previous_position and previous["profiles"].get(st) != current_digests[st]]
+    if changed:
+        click.echo(f"⚠️ Profiles changed since the previous run for {len(changed)} STs; recomputing them.")
+
+    condensed = np.zeros(n_samples * (n_samples - 1) // 2, dtype=np.int16)
+    if len(reused):
+        previous_values = previous_df.to_numpy()
+        source = np.array([previous_position[labels[i]] for i in reused])
+        for k, (row, src) in enumerate(zip(reused[:-1], source[:-1])):
+            cols = reused[k + 1:]
+            condensed[condensed_offset(n_samples, row) + cols - row - 1] = previous_values[src, source[k + 1:]]
+
+    new_rows = np.setdiff1d(np.arange(n_samples), reused)
+    click.echo(f"♻️  Reusing {len(reused)} STs from {previous_matrix}, computing {len(new_rows)} new rows.")
+    if len(new_rows):
+        new_distances = calculte_distance_matrix(mat, cpus=cpus, allowed_missing=allowed_missing, rows=new_rows)
+        for row, distances in zip(new_rows, new_distances):
+            before = np.arange(row)
+            condensed[condensed_offset(n_samples, before) + row - before - 1] = distances[:row]
+            condensed[condensed_offset(n_samples, row):condensed_offset(n_samples, row + 1)] = distances[row + 1:]
+
+    return condensed
+
+
+def condensed_pairs(positions: np.ndarray, n_samples: int) -> tuple[np.ndarray, np.ndarray]:
+    """Row and column (row < column) of sorted positions in a condensed vector."""
+    row_starts = condensed_offset(n_samples, np.arange(n_samples + 1)).clip(max=n_samples * (n_samples - 1) // 2)
+    rows = np.searchsorted(row_starts, positions, side="right") - 1
+    return rows, positions - row_starts[rows] + rows + 1
+
+
+def _upper_graph(condensed: np.ndarray, n_samples: int, pairs: np.ndarray | None = None) -> csr_matrix:
+    """
+    Upper-triangle CSR graph over the given condensed positions (all non-zero ones by default),
+    laid out in row-major order. Zero distances are not edges.
+    """
+    positions = np.flatnonzero(condensed) if pairs is None else pairs[condensed[pairs] > 0]
+    rows, cols = condensed_pairs(positions, n_samples)
+    indptr = np.searchsorted(rows, np.arange(n_samples + 1))
+    return csr_matrix((condensed[positions].astype(np.float64), cols, indptr), shape=(n_samples, n_samples))
+
+
+def knn_candidate_pairs(condensed: np.ndarray, n_samples: int, k: int,
+                        threshold: int | None = None) -> np.ndarray:
+    """
+    Condensed positions of candidate edges: for every profile its k nearest neighbours
+    (all neighbours tied with the k-th distance included) plus every pair within threshold.
+    """
+    candidates = []
+    for row in range(n_samples):
+        distances = condensed_row(condensed, n_samples, row)
+        distances[row] = 0
+        nonzero = distances > 0
+        limit = threshold or 0
+        if nonzero.sum() > k:
+            limit = max(limit, np.partition(distances[nonzero], k - 1)[k - 1])
+        else:
+            limit = max(limit, distances.max())
+        # keep only j > row from this side, j < row is stored as (j, row)
+        neighbours = np.flatnonzero(nonzero & (distances <= limit))
+        low, high = np.minimum(neighbours, row), np.maximum(neighbours, row)
+        candidates.append(condensed_offset(n_samples, low) + high - low - 1)
+    return np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+
+
+def _tree_is_minimum(condensed: np.ndarray, n_samples: int, mst: csr_matrix) -> bool:
+    """
+    Cycle property check of a spanning tree against all pairs: it is a minimum spanning tree
+    of the full graph iff no pair has a (non-zero) distance below the largest tree edge on the
+    path between its ends. That largest edge is the weight at which Kruskal's algorithm over
+    the tree edges joins the two ends, so all pairs are covered in O(N²) while merging.
+    """
+    tree = mst.tocoo()
+    path_max = np.zeros_like(condensed)
+    component = np.arange(n_samples)
+    members = [np.array([i]) for i in range(n_samples)]
+    for edge in np.argsort(tree.data, kind="stable"):
+        a, b = component[tree.row[edge]], component[tree.col[edge]]
+        if len(members[a]) < len(members[b]):
+            a, b = b, a
+        low = np.minimum.outer(members[a], members[b]).ravel()
+        high = np.maximum.outer(members[a], members[b]).ravel()
+        path_max[condensed_offset(n_samples, low) + high - low - 1] = tree.data[edge]
+        component[members[b]] = a
+        members[a], members[b] = np.concatenate([members[a], members[b]]), None
+    return bool(np.all((condensed >= path_max) | (condensed == 0)))
+
+
+def _mst_edges(mst: csr_matrix, labels: list[str]) -> np.ndarray:
+    """Edge list (source, target, distance) of a minimum spanning tree, in row-major order."""
+    mst = mst.tocoo()
+    order = np.lexsort((mst.col, mst.row))
+    edges = [(labels[i], labels[j], int(w))
+             for i, j, w in zip(mst.row[order], mst.col[order], mst.data[order])]
     return np.array(edges, dtype=object)
 
 
+def calculate_mst(distance_matrix: np.ndarray, labels: list[str],
+                  knn: int = 0, knn_threshold: int | None = None) -> np.ndarray:
+    """
+    Compute the Minimum Spanning Tree (MST) from the allelic distances, given either
+    in condensed form or as a square matrix. Zero distances are not treated as edges.
+
+    With knn > 0 the MST is computed on a sparse candidate graph (see knn_candidate_pairs)
+    and checked against all pairs (see _tree_is_minimum); if the candidate graph is
+    disconnected or its tree is not minimum, the full graph is used instead.
+    """
+    condensed = distance_matrix if distance_matrix.ndim == 1 else squareform(distance_matrix, checks=False)
+    n_samples = len(labels)
+
+    if knn > 0:
+        graph = _upper_graph(condensed, n_samples, knn_candidate_pairs(condensed, n_samples, knn, knn_threshold))
+        n_components, _ = connected_components(graph, directed=False)
+        if n_components == 1:
+            mst = minimum_spanning_tree(graph)
+            if _tree_is_minimum(condensed, n_samples, mst):
+                return _mst_edges(mst, labels)
+            click.echo("⚠️ k-NN candidate graph misses an MST edge; using the full graph.")
+        else:
+            click.echo(f"⚠️ k-NN candidate graph has {n_components} components; using the full graph.")
+
+    return _mst_edges(minimum_spanning_tree(_upper_graph(condensed, n_samples)), labels)
+
+
+# ---------- HIERARCHICAL CLUSTERS ----------
+
+def _st_sort_key(label: str) -> tuple:
+    """Numeric STs first in numeric order, then other ids (e.g. local_x) alphabetically."""
+    return (0, int(label), "") if label.isdigit() else (1, 0, label)
+
+
+def hiercc_clusters(edges: np.ndarray, labels: list[str], thresholds: list[int],
+                    zero_pairs: tuple[np.ndarray, np.ndarray] | None = None) -> dict[int, dict[str, str]]:
+    """
+    Single-linkage clusters (HierCC-style) at each threshold, from the MST edge list.
+    Components of MST edges with distance <= t are exactly the single-linkage clusters at t;
+    zero_pairs (row, column index pairs at distance 0, which are not MST edges) are always joined.
+    Each cluster is named after its smallest ST, as in HierCC.
+    Union-find over the sorted edges makes this O(E·α(N)) plus one labelling pass per threshold.
+    Returns: {threshold: {ST_ID: cluster name}}
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    parent = list(range(len(labels)))
+    name = list(labels)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[rj] = ri
+            name[ri] = min(name[ri], name[rj], key=_st_sort_key)
+
+    if zero_pairs is not None:
+        for i, j in zip(*zero_pairs):
+            union(int(i), int(j))
+
+    sorted_edges = sorted(((int(d), index[s], index[t]) for s, t, d in edges), key=lambda e: e[0])
+    clusters, k = {}, 0
+    for threshold in sorted(thresholds):
+        while k < len(sorted_edges) and sorted_edges[k][0] <= threshold:
+            union(sorted_edges[k][1], sorted_edges[k][2])
+            k += 1
+        clusters[threshold] = {label: name[find(i)] for i, label in enumerate(labels)}
+    return clusters
+
+
 # ---------- UTILITIES ----------
 
-def load_profiles_to_dict(profiles_path: str) -> dict[str, np.ndarray]:
+MISSING_ALLELES = ("", "-", "NA")
+
+
+def _parse_alleles(st_id: str, fields: list[str]) -> list[int]:
+    """Convert allele fields of a single profile to integers, 0 marks a missing allele."""
+    try:
+        return [int(x) if x not in MISSING_ALLELES else 0 for x in fields]
+    except ValueError:
+        raise ValueError(f"Invalid allele values in profile for {st_id}: {fields}")
+
+
+def _iter_profiles(handle, n_loci: int, wanted: set[str] | None = None):
+    """Yield (ST_ID, alleles) for every profile line of an open profiles.list (header already consumed)."""
+    for line in handle:
+        st_id, _, rest = line.rstrip("\r\n").partition("\t")
+        if not rest or (wanted is not None and st_id not in wanted):
+            continue
+        fields = rest.split("\t")
+        if len(fields) != n_loci:
+            raise ValueError(f"Profile for {st_id} has {len(fields)} alleles, expected {n_loci}")
+        # negative allele numbers are treated as missing, as are zeros
+        yield st_id, np.clip(_parse_alleles(st_id, fields), 0, None)
+
+
+def load_profiles(profiles_path: str,
+                  selected_sts: list[str] | None = None) -> tuple[np.ndarray, dict[str, int]]:
     """
-    Load all profiles from a profiles.list file into a dictionary.
-    Returns: {ST_ID: np.array([ST_ID, allele_1, allele_2, ...])}
+    Stream a profiles.list file into a contiguous uint32 allele matrix.
+    Only STs listed in selected_sts are parsed (all STs when None).
+    Returns: (alleles, {ST_ID: row index in alleles})
     """
-    profiles = {}
+    wanted = set(selected_sts) if selected_sts is not None else None
+    index = {}
     with open(profiles_path) as f:
-        header = f.readline().strip().split("\t")
-        for line in f:
-            parts = line.strip().split("\t")
-            if not parts or len(parts) < 2:
-                continue
-            st_id = parts[0]
-            try:
-                alleles = [float(x) if x not in ("", "-", "NA") else 0.0 for x in parts[1:]]
-            except ValueError:
-                raise ValueError(f"Invalid allele values in profile for {st_id}: {parts[1:]}")
-            # prepend ST ID as first element (kept as string for labeling)
-            row = np.array([st_id] + alleles, dtype=object)
-            profiles[st_id] = row
-    return profiles
-
-def extract_profiles(profiles_public: dict[str, np.ndarray],
-                     profiles_local: dict[str, np.ndarray] | None,
-                     selected_sts: list[str]) -> np.ndarray:
+        header = f.readline().rstrip("\r\n").split("\t")
+        n_loci = len(header) - 1
+        capacity = len(wanted) if wanted is not None else 1024
+        alleles = np.zeros((capacity, n_loci), dtype=np.uint32)
+
+        for st_id, row_alleles in _iter_profiles(f, n_loci, wanted):
+            row = index.get(st_id, len(index))
+            if row == alleles.shape[0]:
+                alleles = np.resize(alleles, (2 * alleles.shape[0], n_loci))
+            alleles[row] = row_alleles
+            index[st_id] = row
+
+    return alleles[:len(index)].copy(), index
+
+
+# ---------- BINARY PROFILE CACHE ----------
+
+PROFILE_CACHE_VERSION = 1
+
+
+def profile_cache_dir(profiles_path: str) -> str:
+    """Directory of the binary sidecar written next to a profiles.list file."""
+    return f"{profiles_path}.cache"
+
+
+def _source_signature(profiles_path: str) -> dict:
+    stat = os.stat(profiles_path)
+    return {"version": PROFILE_CACHE_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def profile_cache_is_fresh(profiles_path: str) -> bool:
+    """True when the sidecar exists and was built from the current size/mtime of profiles_path."""
+    meta_path = os.path.join(profile_cache_dir(profiles_path), "source.json")
+    try:
+        with open(meta_path) as f:
+            return json.load(f) == _source_signature(profiles_path)
+    except (OSError, ValueError):
+        return False
+
+
+def write_profile_cache(profiles_path: str) -> str:
+    """
+    Convert a profiles.list file into a binary sidecar directory containing:
+    - alleles.npy  uint32 allele matrix (profiles x loci), rows in file order
+    - ids.npy      ST ids sorted lexicographically
+    - rows.npy     row in alleles.npy for each entry of ids.npy
+    - source.json  size and mtime of the source file, used for invalidation
+    The sidecar is assembled in a uniquely named sibling directory and renamed into place,
+    so concurrent runs never write into the same files or see a partial sidecar.
+    """
+    cache_dir = profile_cache_dir(profiles_path)
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    prefix = f".{os.path.basename(cache_dir)}.tmp-"
+    signature = _source_signature(profiles_path)
+
+    staging = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    try:
+        with open(profiles_path) as f:
+            n_loci = len(f.readline().rstrip("\r\n").split("\t")) - 1
+            n_profiles = sum(1 for line in f if line.rstrip("\r\n").partition("\t")[2])
+
+        alleles = np.lib.format.open_memmap(os.path.join(staging, "alleles.npy"), mode="w+",
+                                            dtype=np.uint32, shape=(n_profiles, n_loci))
+        index = {}
+        with open(profiles_path) as f:
+            f.readline()
+            for row, (st_id, row_alleles) in enumerate(_iter_profiles(f, n_loci)):
+                alleles[row] = row_alleles
+                # later duplicates of an ST win, as in load_profiles
+                index[st_id] = row
+        alleles.flush()
+        del alleles
+
+        ids = np.array(list(index.keys()), dtype=str)
+        rows = np.fromiter(index.values(), dtype=np.int64, count=len(index))
+        order = np.argsort(ids)
+        np.save(os.path.join(staging, "ids.npy"), ids[order])
+        np.save(os.path.join(staging, "rows.npy"), rows[order])
+        with open(os.path.join(staging, "source.json"), "w") as f:
+            json.dump(signature, f)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(staging, cache_dir)
+    except OSError:
+        # a stale sidecar (or one just written by another run) is in the way; move it aside
+        stale = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        try:
+            os.rename(cache_dir, stale)
+            os.rename(staging, cache_dir)
+        except OSError:
+            # another run installed its sidecar in the meantime
+            shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(stale, ignore_errors=True)
+    return cache_dir
+
+
+def load_profile_cache(profiles_path: str,
+                       selected_sts: list[str]) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Fetch selected STs from the memory-mapped sidecar of profiles_path.
+    Only the rows of requested profiles are read from disk.
+    Returns: (alleles, {ST_ID: row index in alleles}), same as load_profiles.
+    """
+    cache_dir = profile_cache_dir(profiles_path)
+    all_alleles = np.load(os.path.join(cache_dir, "alleles.npy"), mmap_mode="r")
+    ids = np.load(os.path.join(cache_dir, "ids.npy"))
+    rows = np.load(os.path.join(cache_dir, "rows.npy"))
+
+    wanted = np.array(list(dict.fromkeys(selected_sts)), dtype=str)
+    positions = np.minimum(np.searchsorted(ids, wanted), max(len(ids) - 1, 0))
+    found = (ids[positions] == wanted) if len(ids) else np.zeros(len(wanted), dtype=bool)
+
+    found_rows = rows[positions[found]]
+    alleles = np.asarray(all_alleles[found_rows], dtype=np.uint32)
+    index = {st: i for i, st in enumerate(wanted[found].tolist())}
+    return alleles, index
+
+
+def open_profiles(profiles_path: str, selected_sts: list[str],
+                  build_cache: bool = False) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Load selected profiles from the binary sidecar when it is fresh, otherwise from the text file.
+    With build_cache a missing or stale sidecar is (re)built first.
+    """
+    if build_cache and not profile_cache_is_fresh(profiles_path):
+        click.echo(f"🗄️  Building binary profile cache for: {profiles_path}")
+        try:
+            write_profile_cache(profiles_path)
+        except OSError as e:
+            click.echo(f"⚠️ Could not write profile cache ({e}); reading text profiles.")
+
+    if profile_cache_is_fresh(profiles_path):
+        return load_profile_cache(profiles_path, selected_sts)
+    return load_profiles(profiles_path, selected_sts)
+
+
+def extract_profiles(profiles_public: tuple[np.ndarray, dict[str, int]],
+                     profiles_local: tuple[np.ndarray, dict[str, int]] | None,
+                     selected_sts: list[str]) -> tuple[np.ndarray, list[str]]:
     """
     Combine allele profiles for cgMLST IDs from public and local sources.
-    IDs starting with 'local_' are fetched from the local profile dictionary.
+    IDs starting with 'local_' are fetched from the local profile store.
+    Returns the allele matrix in selected_sts order and the matching list of labels.
     """
-    rows = []
+    public_alleles, public_index = profiles_public
+    local_alleles, local_index = profiles_local if profiles_local else (None, {})
+
+    labels, public_rows, local_rows = [], [], []
     for st in selected_sts:
-        if st.startswith("local_") and profiles_local and st in profiles_local:
-            rows.append(profiles_local[st])
-        elif st in profiles_public:
-            rows.append(profiles_public[st])
+        if st.startswith("local_") and st in local_index:
+            local_rows.append((len(labels), local_index[st]))
+        elif st in public_index:
+            public_rows.append((len(labels), public_index[st]))
         else:
             click.echo(f"Warning: cgMLST ID {st} not found in either profile source.")
-    if not rows:
+            continue
+        labels.append(st)
+    if not labels:
         raise ValueError("No cgMLST profiles were found for provided metadata.")
-    return np.vstack(rows)
+
+    mat = np.zeros((len(labels), public_alleles.shape[1]), dtype=np.uint32)
+    for alleles, rows in ((public_alleles, public_rows), (local_alleles, local_rows)):
+        if rows:
+            out_rows, src_rows = np.array(rows).T
+            mat[out_rows] = alleles[src_rows]
+    return mat, labels
+
+
+# ---------- LAYOUT ----------
+
+# Largest MST still laid out with Kamada-Kawai in "auto" mode (O(N^2) memory, ~O(N^3) time).
+KAMADA_KAWAI_MAX_NODES = 500
+
+
+def equal_angle_layout(G: nx.Graph, weight: str = "weight") -> dict:
+    """
+    Radial equal-angle layout of a tree (or forest) in O(N).
+    Each tree is rooted at its highest-degree node (the first one in node order on ties); every subtree receives an angular
+    wedge proportional to its number of nodes and children are placed in the middle of
+    their wedge at the edge length away from the parent. Trees of a forest are placed
+    side by side. Positions are rescaled to [-1, 1] like networkx layouts.
+    """
+    pos = {}
+    x_offset = 0.0
+    for component in nx.connected_components(G):
+        # component is a set, its order depends on string hashing
+        root = max((n for n in G if n in component), key=G.degree)
+
+        # iterative DFS: parent links and visiting order
+        parent, order, stack = {root: None}, [], [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            for child in G.neighbors(node):
+                if child not in parent:
+                    parent[child] = node
+                    stack.append(child)
+
+        size = dict.fromkeys(order, 1)
+        for node in reversed(order[1:]):
+            size[parent[node]] += size[node]
+
+        coords = {root: np.zeros(2)}
+        wedge = {root: (0.0, 2 * np.pi)}
+        for node in order:
+            start, end = wedge[node]
+            children = [c for c in G.neighbors(node) if parent.get(c) == node]
+            total = sum(size[c] for c in children)
+            for child in children:
+                span = (end - start) * size[child] / total
+                wedge[child] = (start, start + span)
+                angle = start + span / 2
+                length = max(G[node][child].get(weight, 1), 1)
+                coords[child] = coords[node] + length * np.array([np.cos(angle), np.sin(angle)])
+                start += span
+
+        xy = np.array([coords[n] for n in order])
+        xy[:, 0] += x_offset - xy[:, 0].min()
+        x_offset = xy[:, 0].max() + 10
+        pos.update(zip(order, xy))
+
+    if not pos:
+        return pos
+    nodes = list(pos)
+    scaled = nx.rescale_layout(np.array([pos[n] for n in nodes]))
+    return dict(zip(nodes, scaled))
+
+
+def mst_layout(G: nx.Graph, layout: str = "auto") -> dict:
+    """
+    Node positions for the MST. "auto" keeps Kamada-Kawai for small trees and switches
+    to the linear-time equal-angle layout above KAMADA_KAWAI_MAX_NODES nodes.
+    """
+    if layout == "auto":
+        layout = "kamada-kawai" if G.number_of_nodes() <= KAMADA_KAWAI_MAX_NODES else "equal-angle"
+    if layout == "kamada-kawai":
+        return nx.kamada_kawai_layout(G, weight="weight")
+    if layout == "equal-angle":
+        return equal_angle_layout(G, weight="weight")
+    raise ValueError(f"Unknown MST layout: {layout}")
+
+
+# ---------- RENDERING ----------
+
+# Trees with more nodes are drawn with WebGL (Scattergl) in "auto" renderer mode.
+WEBGL_MIN_NODES = 1000
+# Decimals kept for coordinates in WebGL mode; layouts are scaled to [-1, 1].
+COORD_DECIMALS = 4
+# Edge label annotations are SVG elements; in WebGL mode they are only built for smaller trees.
+EDGE_LABELS_MAX_EDGES = 1000
+
+
+def _compact(values: list, decimals: int = COORD_DECIMALS) -> np.ndarray:
+    """Round numbers (None -> NaN gap) into a float32 array, serialized by plotly as a typed array."""
+    return np.round(np.array(values, dtype=np.float64), decimals).astype(np.float32)
+
+
+def _include_plotlyjs(plotly_js: str, output_html: str) -> str | bool:
+    """
+    Translate --plotly-js into the include_plotlyjs argument of write_html.
+    A path to a .js file is shared between reports: it is written once with the bundled
+    plotly.js and referenced relative to the HTML file.
+    """
+    if plotly_js == "inline":
+        return True
+    if plotly_js in ("cdn", "directory"):
+        return plotly_js
+    if not os.path.exists(plotly_js):
+        os.makedirs(os.path.dirname(os.path.abspath(plotly_js)), exist_ok=True)
+        with open(plotly_js, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+    return os.path.relpath(os.path.abspath(plotly_js), os.path.dirname(os.path.abspath(output_html)))
 
 
 def visualize_mst(edges: np.ndarray, counts: dict[str, int],
                   color_map: dict[str, str] | None = None,
                   color_label: str | None = None,
                   output_html: str | None = None,
-                  sample_map:  dict | None = None) -> go.Figure:
+                  sample_map:  dict | None = None,
+                  layout: str = "auto",
+                  renderer: str = "auto",
+                  plotly_js: str = "inline") -> go.Figure:
     """
     Create an interactive MST visualization (Plotly preferred, static matplotlib fallback).
     Node size is proportional to sample count, color depends on metadata attribute.
+
+    renderer "webgl" draws with Scattergl and ships coordinates and sizes as rounded
+    float32 typed arrays; "auto" switches to it above WEBGL_MIN_NODES nodes.
+    plotly_js is "inline", "cdn", "directory" or a path to a shared plotly.js file.
     """
     # --- Build MST graph ---
     G = nx.Graph()
@@ -128,7 +809,10 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
         G.add_edge(s, t, weight=min(d, 50), true_weight=d)
 
     # Optimize position of nodes
-    pos = nx.kamada_kawai_layout(G, weight="weight")
+    pos = mst_layout(G, layout)
+
+    webgl = renderer == "webgl" or (renderer == "auto" and G.number_of_nodes() > WEBGL_MIN_NODES)
+    Scatter = go.Scattergl if webgl else go.Scatter
 
     # --- Build edge coordinates and distance hover text ---
     edge_x, edge_y, edge_text = [], [], []
@@ -140,14 +824,19 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
         edge_y += [y0, y1, None]
         edge_text.append(f"{u}–{v}: {dist} allelic differences")
 
-    edge_trace = go.Scatter(
-        x=edge_x,
-        y=edge_y,
-        mode="lines",
-        line=dict(width=1.5, color="#888"),  # constant color
-        hoverinfo="text",
-        text=edge_text,
-    )
+    if webgl:
+        # hover on edges is served by the midpoint markers below
+        edge_trace = Scatter(x=_compact(edge_x), y=_compact(edge_y), mode="lines",
+                             line=dict(width=1.5, color="#888"), hoverinfo="skip")
+    else:
+        edge_trace = Scatter(
+            x=edge_x,
+            y=edge_y,
+            mode="lines",
+            line=dict(width=1.5, color="#888"),  # constant color
+            hoverinfo="text",
+            text=edge_text,
+        )
 
     # --- Determine if color values are numeric or categorical ---
 
@@ -216,7 +905,10 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
         )
 
 
-    node_trace = go.Scatter(
+    if webgl:
+        node_x, node_y, node_size = _compact(node_x), _compact(node_y), _compact(node_size, 1)
+
+    node_trace = Scatter(
         x=node_x, y=node_y,
         mode="markers+text",
         text=[str(n) for n in G.nodes()],
@@ -257,7 +949,10 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
         mnode_text.append(f"{w} allelic differences")
 
 
-    mnode_trace = go.Scatter(
+    if webgl:
+        mnode_x, mnode_y = _compact(mnode_x), _compact(mnode_y)
+
+    mnode_trace = Scatter(
         x=mnode_x,
         y=mnode_y,
         mode="markers",
@@ -303,8 +998,9 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
     # --- Create toggleable edge label annotations ---
     offset_scale = 0.03  # how far to offset labels perpendicular to edge
     annotations = []
+    edge_labels = not webgl or G.number_of_edges() <= EDGE_LABELS_MAX_EDGES
 
-    for u, v, data in G.edges(data=True):
+    for u, v, data in (G.edges(data=True) if edge_labels else []):
         # edge direction and midpoint
         x_u, y_u = pos[u]
         x_v, y_v = pos[v]
@@ -338,33 +1034,36 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
         )
 
     # --- Add interactive buttons ---
-    fig.update_layout(
-        updatemenus=[{
-            "buttons": [
-                {
-                    "label": "Show Edge Labels",
-                    "method": "relayout",
-                    "args": [{"annotations": annotations}]
-                },
-                {
-                    "label": "Hide Edge Labels",
-                    "method": "relayout",
-                    "args": [{"annotations": []}]
-                }
-            ],
-            "direction": "down",
-            "x": 1.05,
-            "y": 1.0,
-            "showactive": True,
-            "xanchor": "left",
-            "yanchor": "top"
-        }]
-    )
+    if edge_labels:
+        fig.update_layout(
+            updatemenus=[{
+                "buttons": [
+                    {
+                        "label": "Show Edge Labels",
+                        "method": "relayout",
+                        "args": [{"annotations": annotations}]
+                    },
+                    {
+                        "label": "Hide Edge Labels",
+                        "method": "relayout",
+                        "args": [{"annotations": []}]
+                    }
+                ],
+                "direction": "down",
+                "x": 1.05,
+                "y": 1.0,
+                "showactive": True,
+                "xanchor": "left",
+                "yanchor": "top"
+            }]
+        )
 
     if output_html:
-        fig.write_html(output_html, auto_open=True)
+        fig.write_html(output_html, auto_open=True, include_plotlyjs=_include_plotlyjs(plotly_js, output_html))
         click.echo(f"🌐 Interactive MST visualization saved to: {output_html}")
 
+    return fig
+
 
 # ---------- CLI ----------
 
@@ -379,6 +1078,14 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
               help="Metadata column used for node coloring.")
 @click.option("--plot", "plot_html", type=click.Path(dir_okay=False),
               help="Output path for interactive MST visualization (HTML).")
+@click.option("--layout", type=click.Choice(["auto", "equal-angle", "kamada-kawai"]), default="auto",
+              show_default=True,
+              help=f"MST layout; auto uses kamada-kawai up to {KAMADA_KAWAI_MAX_NODES} nodes and equal-angle above.")
+@click.option("--renderer", type=click.Choice(["auto", "svg", "webgl"]), default="auto", show_default=True,
+              help=f"Plot renderer; auto uses webgl (Scattergl, compact typed arrays) above {WEBGL_MIN_NODES} nodes.")
+@click.option("--plotly-js", default="inline", show_default=True,
+              help="How the HTML loads plotly.js: inline, cdn, directory, or a path to a shared .js file "
+                   "(written once if missing, referenced relative to the HTML).")
 @click.option("--output", "output_path", type=click.Path(dir_okay=False),
               help="Optional output path for the distance matrix (TSV).")
 @click.option("--mst-output", "mst_output", type=click.Path(dir_okay=False),
@@ -387,8 +1094,26 @@ def visualize_mst(edges: np.ndarray, counts: dict[str, int],
               help="Number of CPU threads to use.")
 @click.option("-m", "--missing", default=0.05, show_default=True,
               help="Allowed fraction of missing loci (0–1).")
+@click.option("--mst-knn", default=0, show_default=True,
+              help="Build the MST on a graph of the k nearest neighbours of every ST instead of all pairs "
+                   "(0 uses all pairs). Falls back to all pairs when that graph is disconnected or "
+                   "its tree is not a minimum spanning tree of all pairs.")
+@click.option("--mst-knn-threshold", type=int,
+              help="With --mst-knn, also keep every pair at most this many allelic differences apart.")
+@click.option("--hiercc", "hiercc_thresholds",
+              help="Comma-separated allelic distance thresholds (e.g. 5,10). Single-linkage clusters at each "
+                   "threshold are derived from the MST and added as HC<t>_mst columns (usable with --color-by).")
+@click.option("--clusters-output", type=click.Path(dir_okay=False),
+              help="Output path for the metadata TSV extended with the HC<t>_mst columns.")
+@click.option("--previous-matrix", type=click.Path(exists=True, dir_okay=False),
+              help="Distance matrix (TSV) written by a previous run with --output. Distances between STs it "
+                   "already contains are reused; only rows for new STs are computed.")
+@click.option("--build-cache", is_flag=True,
+              help="Write a binary sidecar (<profiles>.cache) next to each profiles file when missing or stale. "
+                   "A fresh sidecar is always used automatically.")
 def main(metadata, profiles, local_profiles, color_by,
-         plot_html, output_path, mst_output, threads, missing):
+         plot_html, layout, renderer, plotly_js, output_path, mst_output, threads, missing, mst_knn, mst_knn_threshold,
+         hiercc_thresholds, clusters_output, previous_matrix, build_cache):
     """
     Compute the cgMLST allelic distance matrix and MST using:
     - metadata.tsv (contains cgMLST, HC10, etc.)
@@ -415,47 +1140,63 @@ def main(metadata, profiles, local_profiles, color_by,
 
     # Load public and local profile sets
     click.echo(f"📚 Loading public profiles from: {profiles}")
-    profiles_public = load_profiles_to_dict(profiles)
+    profiles_public = open_profiles(profiles, selected_sts, build_cache)
 
     profiles_local = None
     if local_profiles:
         click.echo(f"📂 Loading local profiles from: {local_profiles}")
-        profiles_local = load_profiles_to_dict(local_profiles)
-
-    # Prepare color mapping
-    if color_by in meta.columns:
-        color_map = meta.groupby("cgMLST")[color_by].first().to_dict()
-        click.echo(f"🎨 Coloring nodes by metadata column: {color_by}")
-    else:
-        click.echo(f"⚠️ Column '{color_by}' not found in metadata file; using single color.")
-        color_map = {k: "NA" for k in selected_sts}
+        profiles_local = open_profiles(local_profiles, selected_sts, build_cache)
 
     # Extract allele data
     click.echo(f"🔎 Extracting profiles for {len(selected_sts)} cgMLST IDs...")
-    mat = extract_profiles(profiles_public, profiles_local, selected_sts)
+    mat, labels = extract_profiles(profiles_public, profiles_local, selected_sts)
 
     # Compute allelic distance matrix
     click.echo("⚙️  Calculating allelic distance matrix...")
-    dist = calculte_distance_matrix(mat, cpus=threads, allowed_missing=missing)
-    labels = mat[:, 0].astype(str).tolist()
+    if previous_matrix:
+        dist = update_distance_matrix(mat, labels, previous_matrix, cpus=threads, allowed_missing=missing)
+    else:
+        dist = calculate_condensed_distances(mat, cpus=threads, allowed_missing=missing)
 
     if output_path:
-        dist_df = pd.DataFrame(dist, index=labels, columns=labels)
+        dist_df = pd.DataFrame(squareform_distances(dist, self_distances(mat, missing)), index=labels, columns=labels)
         dist_df.to_csv(output_path, sep="\t", index=True)
+        write_profile_digests(output_path, mat, labels, missing)
         click.echo(f"💾 Distance matrix with labels saved to: {output_path}")
 
     # Compute MST
     click.echo("🌳 Building MST...")
 
-    edges = calculate_mst(dist, labels)
+    edges = calculate_mst(dist, labels, knn=mst_knn, knn_threshold=mst_knn_threshold)
 
     if mst_output:
         np.savetxt(mst_output, edges, fmt="%s", delimiter="\t",
                    header="source\ttarget\tdistance", comments="")
         click.echo(f"💾 MST edge list saved to: {mst_output}")
 
+    # Single-linkage clusters for all STs, including local ones without HierCC assignment
+    if hiercc_thresholds:
+        thresholds = [int(t) for t in hiercc_thresholds.split(",")]
+        zero_pairs = condensed_pairs(np.flatnonzero(dist == 0), len(labels))
+        clusters = hiercc_clusters(edges, labels, thresholds, zero_pairs)
+        for threshold, assignment in clusters.items():
+            meta[f"HC{threshold}_mst"] = meta["cgMLST"].map(assignment).fillna("NA")
+        click.echo(f"🧩 Single-linkage clusters computed at thresholds: {hiercc_thresholds}")
+        if clusters_output:
+            meta.to_csv(clusters_output, sep="\t", index=False)
+            click.echo(f"💾 Metadata with cluster columns saved to: {clusters_output}")
+
+    # Prepare color mapping
+    if color_by in meta.columns:
+        color_map = meta.groupby("cgMLST")[color_by].first().to_dict()
+        click.echo(f"🎨 Coloring nodes by metadata column: {color_by}")
+    else:
+        click.echo(f"⚠️ Column '{color_by}' not found in metadata file; using single color.")
+        color_map = {k: "NA" for k in selected_sts}
+
     # Visualize MST
-    visualize_mst(edges, counts, color_map=color_map, color_label=color_by, output_html=plot_html, sample_map = sample_map)
+    visualize_mst(edges, counts, color_map=color_map, color_label=color_by, output_html=plot_html, sample_map = sample_map,
+                  layout=layout, renderer=renderer, plotly_js=plotly_js)
     click.echo("✅ Completed successfully.")
 
 
@@ -1,68 +1,447 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import multiprocessing
 import os
 import json
+import sqlite3
+import time
 from collections import defaultdict
-from typing import List, Tuple, Dict
+from queue import Empty
+from typing import List, Tuple, Dict, Optional
 from Bio import SeqIO
 from Bio.Align import PairwiseAligner
 from pathlib import Path
+import numpy as np
 
+# q-gram length used by the prefilter of cluster_by_threshold
+KMER_SIZE = 12
+# q-grams are built over A, C, G, T and one code shared by all other symbols
+KMER_CODES = np.full(256, 4, dtype=np.uint64)
+for _code, _base in enumerate(b"ACGT"):
+    KMER_CODES[_base] = _code
 
-def seq_identity(a: str, b: str) -> float:
+# seconds between liveness checks of IdentityWorkers while waiting for results
+WORKER_POLL_INTERVAL = 1.0
+
+_aligner = None
+
+
+def make_aligner() -> PairwiseAligner:
+    """
+    Global aligner scoring a match 1 and mismatches and gaps 0, so score = LCS length.
+
+    The scores are set explicitly because PairwiseAligner defaults differ between
+    Biopython releases; these reproduce the identities of Biopython 1.85.
+    """
     aligner = PairwiseAligner()
-    a = a.upper();
-    b = b.upper()
+    aligner.mode = "global"
+    aligner.match_score = 1.0
+    aligner.mismatch_score = 0.0
+    aligner.gap_score = 0.0
+    return aligner
+
 
+def _identity(aligner: PairwiseAligner, a: str, b: str) -> float:
+    """seq_identity for sequences that are already upper-cased."""
     # skip calculations for identical sequences
     if a == b or (not a and not b):
         return 1.0
+    return aligner.score(a, b) / max(len(a), len(b))
+
+
+def seq_identity(a: str, b: str) -> float:
+    global _aligner
+    if _aligner is None:
+        _aligner = make_aligner()
+    return _identity(_aligner, a.upper(), b.upper())
+
+
+def sequence_sketch(seq: str, k: int = KMER_SIZE) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Summary of an upper-cased sequence used to bound seq_identity without aligning.
+
+    Returns (length, per-byte composition, distinct q-gram codes, their counts).
+    """
+    data = np.frombuffer(seq.encode(), dtype=np.uint8)
+    composition = np.bincount(data, minlength=256)
+    if data.size < k:
+        return data.size, composition, np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    codes = KMER_CODES[data]
+    n_kmers = data.size - k + 1
+    kmers = np.zeros(n_kmers, dtype=np.uint64)
+    for offset in range(k):
+        kmers = kmers * np.uint64(5) + codes[offset:offset + n_kmers]
+    values, counts = np.unique(kmers, return_counts=True)
+    return data.size, composition, values, counts
+
+
+def identity_upper_bound(a: Tuple, b: Tuple, k: int = KMER_SIZE) -> float:
+    """
+    Upper bound of seq_identity for two sequence_sketch results; never below the exact value.
+
+    With the make_aligner scores the alignment score is the length of the longest common
+    subsequence (LCS), which is at most min(len) and at most the number of shared symbols.
+    By the q-gram lemma, two sequences whose edit distance is e share at least
+    max(len) - k + 1 - k * e q-grams, which gives a lower bound on e from the number of
+    shared q-grams; len_a + len_b - 2 * LCS (insertions and deletions only) is at least e.
+    """
+    len_a, composition_a, values_a, counts_a = a
+    len_b, composition_b, values_b, counts_b = b
+    longest, shortest = max(len_a, len_b), min(len_a, len_b)
+    if longest == 0:
+        return 1.0
+    _, index_a, index_b = np.intersect1d(values_a, values_b, assume_unique=True, return_indices=True)
+    shared_kmers = int(np.minimum(counts_a[index_a], counts_b[index_b]).sum())
+    missing_kmers = longest - k + 1 - shared_kmers
+    min_edits = -(-missing_kmers // k) if missing_kmers > 0 else 0
+    shared_symbols = int(np.minimum(composition_a, composition_b).sum())
+    best_score = min(shortest, shared_symbols, (len_a + len_b - min_edits) // 2)
+    return best_score / longest
 
-    aln = aligner.align(a, b)[0]
 
-    matches = float(aln.score)
-    return matches / max(len(a), len(b))
+def sequence_digest(seq: str) -> bytes:
+    """128-bit digest of the normalised (upper-cased) sequence."""
+    return hashlib.blake2b(seq.upper().encode(), digest_size=16).digest()
 
 
 def find_identical_sequences(fasta_file: str) -> List[List[str]]:
-    """Fast path for threshold == 1.0."""
+    """
+    Groups (sorted IDs) of sequences that are identical after upper-casing.
+
+    Helper for callers that only need the duplicate groups; main uses
+    stream_identical_sequences, which also keeps singletons and writes the unique FASTA.
+    """
     seq_dict = defaultdict(set)
     for record in SeqIO.parse(fasta_file, "fasta"):
-        seq_str = str(record.seq).upper()
-        seq_dict[seq_str].add(record.id)
+        seq_dict[sequence_digest(str(record.seq))].add(record.id)
     identical_groups = [sorted(list(ids)) for ids in seq_dict.values() if len(ids) > 1]
     return identical_groups
 
 
-def cluster_by_threshold(fasta_file: str, threshold: float) -> List[List[str]]:
+def stream_identical_sequences(fasta_file: str, unique_file: Path) -> List[List[str]]:
+    """
+    Fast path for threshold == 1.0, a single pass over the input.
+
+    Sequences are keyed by sequence_digest, so memory grows with the number of
+    distinct sequences rather than with their total length. The first sequence
+    seen with a given digest is the representative and is written to unique_file
+    right away.
+    Returns: list of clusters in FASTA order of their representatives (first ID).
+    """
+    cluster_index: Dict[bytes, int] = {}
+    clusters: List[List[str]] = []
+    with open(unique_file, 'w') as f:
+        for record in SeqIO.parse(fasta_file, "fasta"):
+            digest = sequence_digest(str(record.seq))
+            idx = cluster_index.get(digest)
+            if idx is None:
+                cluster_index[digest] = len(clusters)
+                clusters.append([record.id])
+                SeqIO.write(record, f, "fasta")
+            else:
+                clusters[idx].append(record.id)
+    return clusters
+
+
+def _identity_worker(tasks, results) -> None:
+    """
+    Worker process of IdentityWorkers, holds its own aligner and copy of the representatives.
+
+    Messages: ("rep", seq) appends a representative, ("chunk", job, seq, indices, threshold)
+    scores seq against the given representatives in order until one passes and reports
+    the (index, identity) pairs it computed, None stops the worker.
+    """
+    aligner = make_aligner()
+    reps: List[str] = []
+    for message in iter(tasks.get, None):
+        if message[0] == "rep":
+            reps.append(message[1])
+            continue
+        _, job, seq, indices, threshold = message
+        scored = []
+        for idx in indices:
+            scored.append((idx, _identity(aligner, seq, reps[idx])))
+            if scored[-1][1] >= threshold:
+                break
+        results.put((job, scored))
+
+
+class IdentityWorkers:
+    """
+    Pool of processes searching for the first representative a sequence is identical enough to.
+
+    Every worker keeps a persistent aligner (make_aligner) and all representatives, which are
+    broadcast once when they are created, so a search only ships the query and indices.
+    """
+
+    def __init__(self, cpus: int, chunk_size: int = 1):
+        self.chunk_size = chunk_size
+        self.results = multiprocessing.Queue()
+        self.queues = [multiprocessing.Queue() for _ in range(cpus)]
+        self.workers = [multiprocessing.Process(target=_identity_worker, args=(queue, self.results), daemon=True)
+                        for queue in self.queues]
+        for worker in self.workers:
+            worker.start()
+        self.jobs = 0
+
+    def add_representative(self, seq: str) -> None:
+        for queue in self.queues:
+            queue.put(("rep", seq))
+
+    def first_passing(self, seq: str, candidates: List[int], threshold: float,
+                      scored: Optional[Dict[int, float]] = None) -> Optional[int]:
+        """
+        Lowest candidate index whose identity with seq is >= threshold.
+
+        Candidates are scored in waves of one chunk per worker, in index order; a wave
+        with a passing candidate ends the search, so the result equals a serial scan.
+        Computed identities are added to scored if given.
+        """
+        wave_size = self.chunk_size * len(self.queues)
+        for wave_start in range(0, len(candidates), wave_size):
+            wave = candidates[wave_start:wave_start + wave_size]
+            chunks = [wave[i:i + self.chunk_size] for i in range(0, len(wave), self.chunk_size)]
+            for queue, chunk in zip(self.queues, chunks):
+                queue.put(("chunk", self.jobs, seq, chunk, threshold))
+            found = []
+            for _ in chunks:
+                job, chunk_scored = self._result()
+                assert job == self.jobs
+                if scored is not None:
+                    scored.update(chunk_scored)
+                found.extend(idx for idx, identity in chunk_scored if identity >= threshold)
+            self.jobs += 1
+            if found:
+                return min(found)
+        return None
+
+    def _result(self) -> Tuple[int, List[Tuple[int, float]]]:
+        """
+        Next result, raises RuntimeError instead of waiting forever if a worker has died.
+
+        The other workers are terminated then, a dead worker may still hold the lock
+        of the shared result queue.
+        """
+        while True:
+            try:
+                return self.results.get(timeout=WORKER_POLL_INTERVAL)
+            except Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if dead:
+                    for worker in self.workers:
+                        worker.terminate()
+                    raise RuntimeError(f"identity worker {dead[0].pid} exited with code {dead[0].exitcode}")
+
+    def close(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class IdentityCache:
+    """
+    On-disk SQLite cache of pairwise identities shared between runs.
+
+    Entries are keyed by the sorted pair of sequence digests (sequence_digest) and the
+    scoring scheme. Once more than max_entries are stored, the least recently used
+    ones are evicted when the cache is closed. Changes are written by commit(), which
+    releases the database for other runs sharing the file.
+    """
+
+    def __init__(self, path: str, scheme: str, max_entries: int):
+        self.scheme = scheme
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.clock = int(time.time() * 1e6)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS identities (digest_a BLOB, digest_b BLOB, scheme TEXT, identity REAL, "
+            "last_used INTEGER, PRIMARY KEY (digest_a, digest_b, scheme)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS identities_last_used ON identities (last_used)")
+
+    def _tick(self) -> int:
+        self.clock += 1
+        return self.clock
+
+    def get(self, a: bytes, b: bytes) -> Optional[float]:
+        a, b = sorted((a, b))
+        row = self.connection.execute("SELECT identity FROM identities WHERE digest_a = ? AND digest_b = ? "
+                                      "AND scheme = ?", (a, b, self.scheme)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE identities SET last_used = ? WHERE digest_a = ? AND digest_b = ? "
+                                "AND scheme = ?", (self._tick(), a, b, self.scheme))
+        return row[0]
+
+    def put(self, a: bytes, b: bytes, identity: float) -> None:
+        self.misses += 1
+        a, b = sorted((a, b))
+        self.connection.execute("INSERT OR REPLACE INTO identities VALUES (?, ?, ?, ?, ?)",
+                                (a, b, self.scheme, identity, self._tick()))
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self.connection.execute("DELETE FROM identities WHERE last_used <= (SELECT last_used FROM identities "
+                                "ORDER BY last_used DESC LIMIT 1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+        self.connection.close()
+
+
+def pairwise_scheme(aligner: PairwiseAligner) -> str:
+    """IdentityCache scheme key listing every parameter the aligner reports, e.g. 'mode=global'."""
+    parameters = [line.strip().replace(": ", "=") for line in str(aligner).splitlines()[1:]]
+    return ":".join(["PairwiseAligner"] + parameters)
+
+
+# scoring scheme of seq_identity, part of the IdentityCache key
+PAIRWISE_SCHEME = pairwise_scheme(make_aligner())
+
+
+def cluster_by_threshold(fasta_file: str, threshold: float, cpus: int = 1,
+                         cache: Optional[IdentityCache] = None) -> List[List[str]]:
     """
     Greedy clustering by representative:
     - Iterate sequences in FASTA order
     - Assign to the first cluster whose representative has identity >= threshold
     - Otherwise start a new cluster with this sequence as representative
+    Representatives whose identity upper bound (identity_upper_bound) is below the threshold
+    are skipped without aligning; the bound is exact, so the assignment is unchanged.
+    Identities found in cache are not recomputed, new ones are stored and committed per sequence.
+    With cpus > 1 the remaining candidates are aligned by IdentityWorkers.
     Returns: list of clusters as lists of IDs (first ID is the representative).
     """
     records = list(SeqIO.parse(fasta_file, "fasta"))
     if not records:
         return []
-    reps: List[Tuple[str, str]] = []  # (rep_id, rep_seq)
+    reps: List[Tuple[str, str, Tuple, bytes]] = []  # (rep_id, rep_seq, rep_sketch, rep_digest)
     clusters: List[List[str]] = []
+    aligner = make_aligner()
+    workers = IdentityWorkers(cpus) if cpus > 1 else None
+
+    try:
+        for rec in records:
+            sid = rec.id
+            s = str(rec.seq).upper()
+            sketch = sequence_sketch(s)
+            digest = sequence_digest(s) if cache is not None else None
+            candidates = [idx for idx, (_, _, rep_sketch, _) in enumerate(reps)
+                          if identity_upper_bound(sketch, rep_sketch) >= threshold]
+
+            # cached identities settle candidates up to the first cached pass,
+            # only the unknown ones before it still need an alignment
+            placed = None
+            if cache is not None:
+                unknown = []
+                for idx in candidates:
+                    identity = cache.get(digest, reps[idx][3])
+                    if identity is None:
+                        unknown.append(idx)
+                    elif identity >= threshold:
+                        placed = idx
+                        break
+                candidates = unknown
+
+            scored: Dict[int, float] = {}
+            if workers is not None:
+                found = workers.first_passing(s, candidates, threshold, scored)
+            else:
+                found = None
+                for idx in candidates:
+                    scored[idx] = _identity(aligner, s, reps[idx][1])
+                    if scored[idx] >= threshold:
+                        found = idx
+                        break
+            if cache is not None:
+                for idx, identity in scored.items():
+                    cache.put(digest, reps[idx][3], identity)
+                cache.commit()
+            if found is not None:
+                placed = found
+
+            if placed is not None:
+                clusters[placed].append(sid)
+            else:
+                reps.append((sid, s, sketch, digest))
+                clusters.append([sid])  # representative is first element
+                if workers is not None:
+                    workers.add_representative(s)
+    finally:
+        if workers is not None:
+            workers.close()
 
-    for rec in records:
-        sid = rec.id
-        s = str(rec.seq).upper()
-        placed = False
-        for idx, (rep_id, rep_seq) in enumerate(reps):
-            if seq_identity(s, rep_seq) >= threshold:
-                clusters[idx].append(sid)
-                placed = True
-                break
-        if not placed:
-            reps.append((sid, s))
-            clusters.append([sid])  # representative is first element
+    return clusters
+
+
+def aligned_identities(reps: np.ndarray, reps_compared: np.ndarray, row: np.ndarray,
+                       row_compared: np.ndarray) -> np.ndarray:
+    """
+    Identity of one aligned sequence against all representatives at once.
+
+    Identity is the fraction of equal columns among columns compared in both
+    sequences; with no comparable column the identity is 1.0.
+    """
+    compared = reps_compared & row_compared
+    n_compared = compared.sum(axis=1)
+    n_equal = ((reps == row) & compared).sum(axis=1)
+    return np.divide(n_equal, n_compared, out=np.ones(len(reps)), where=n_compared > 0)
+
+
+def cluster_aligned_by_threshold(fasta_file: str, threshold: float, n_handling: str = "ignore",
+                                 gap_handling: str = "mismatch") -> List[List[str]]:
+    """
+    Greedy clustering like cluster_by_threshold for sequences that are already aligned.
+
+    Identity is a column comparison of upper-cased sequences instead of a pairwise
+    alignment. With n_handling / gap_handling set to "ignore", columns holding an N
+    / a gap in either sequence are left out of the comparison; with "mismatch" they
+    are compared like any other character.
+    Returns: list of clusters as lists of IDs (first ID is the representative).
+    """
+    ignored = np.zeros(256, dtype=bool)
+    if n_handling == "ignore":
+        ignored[ord("N")] = True
+    if gap_handling == "ignore":
+        ignored[ord("-")] = True
+
+    reps = reps_compared = None
+    n_reps = 0
+    clusters: List[List[str]] = []
+    for rec in SeqIO.parse(fasta_file, "fasta"):
+        row = np.frombuffer(str(rec.seq).upper().encode(), dtype=np.uint8)
+        row_compared = ~ignored[row]
+        if reps is None:
+            reps = np.empty((16, row.size), dtype=np.uint8)
+            reps_compared = np.empty((16, row.size), dtype=bool)
+        elif row.size != reps.shape[1]:
+            raise SystemExit(f"ERROR: {rec.id} has length {row.size}, expected {reps.shape[1]} for --aligned input")
+
+        if n_reps:
+            passing = np.flatnonzero(aligned_identities(reps[:n_reps], reps_compared[:n_reps], row,
+                                                        row_compared) >= threshold)
+            if passing.size:
+                clusters[passing[0]].append(rec.id)
+                continue
+
+        if n_reps == len(reps):
+            reps = np.concatenate([reps, np.empty_like(reps)])
+            reps_compared = np.concatenate([reps_compared, np.empty_like(reps_compared)])
+        reps[n_reps] = row
+        reps_compared[n_reps] = row_compared
+        n_reps += 1
+        clusters.append([rec.id])  # representative is first element
 
     return clusters
 
+
 def write_identical_sequences(identical_groups: List[List[str]], basename: Path, file_prefix:str):
     output_file = basename / f"{file_prefix}_ident_seq.csv"
 
@@ -86,7 +465,8 @@ def write_unique_fasta(clusters: List[List[str]], input_fasta: str, basename: Pa
                 SeqIO.write(record, f, "fasta")
                 rep_ids.remove(record.id)  # write each rep once
 
-def write_clusters_json(clusters: List[List[str]], segment_name: str, file_prefix: str, basename: Path, threshold:float):
+def write_clusters_json(clusters: List[List[str]], segment_name: str, file_prefix: str, basename: Path, threshold:float,
+                        cache_stats: Optional[Dict[str, int]] = None):
 
     out_json = {
         segment_name: {
@@ -94,6 +474,8 @@ def write_clusters_json(clusters: List[List[str]], segment_name: str, file_prefi
             "clusters": {}
         }
     }
+    if cache_stats is not None:
+        out_json[segment_name]["identity_cache"] = cache_stats
 
     unique_file = basename  / f"{file_prefix}_sequence_clustering_data.json"
 
@@ -119,6 +501,31 @@ def main():
         "--segment_name", type=str, default='bacterial_genome',
         help="Segment name used to generate json output."
     )
+    parser.add_argument(
+        "--aligned", action="store_true",
+        help="Input is a multiple sequence alignment; for threshold < 1 identity is computed by comparing "
+             "columns instead of aligning every pair"
+    )
+    parser.add_argument(
+        "--n_handling", choices=["ignore", "mismatch"], default="ignore",
+        help="With --aligned: leave columns with N out of the comparison or compare N like any other character"
+    )
+    parser.add_argument(
+        "--gap_handling", choices=["ignore", "mismatch"], default="mismatch",
+        help="With --aligned: leave columns with a gap out of the comparison or compare gaps like any other character"
+    )
+    parser.add_argument(
+        "--cpus", type=int, default=1,
+        help="Number of worker processes aligning candidate representatives for threshold < 1"
+    )
+    parser.add_argument(
+        "--identity_cache", type=str, default=None,
+        help="SQLite file caching pairwise identities between runs (threshold < 1 without --aligned)"
+    )
+    parser.add_argument(
+        "--identity_cache_max_entries", type=int, default=5_000_000,
+        help="Number of identities kept in --identity_cache, least recently used ones are evicted"
+    )
 
     args = parser.parse_args()
 
@@ -130,22 +537,27 @@ def main():
     basename.mkdir(parents=True, exist_ok=True)
 
     # Cluster
+    cache = None
     if args.threshold == 1.0:
-
-        groups = find_identical_sequences(args.input)
-
-        all_ids = [rec.id for rec in SeqIO.parse(args.input, "fasta")]
-        id_in_group = {x for g in groups for x in g}
-        clusters = [g for g in groups]
-        clusters.extend([[sid] for sid in all_ids if sid not in id_in_group])
+        # representatives are written to the unique FASTA while clustering
+        clusters = stream_identical_sequences(args.input, basename / f"{args.output_prefix}_unique.fasta")
+    elif args.aligned:
+        clusters = cluster_aligned_by_threshold(args.input, args.threshold, args.n_handling, args.gap_handling)
     else:
-        clusters = cluster_by_threshold(args.input, args.threshold)
+        if args.identity_cache:
+            cache = IdentityCache(args.identity_cache, PAIRWISE_SCHEME, args.identity_cache_max_entries)
+        try:
+            clusters = cluster_by_threshold(args.input, args.threshold, max(1, args.cpus), cache)
+        finally:
+            if cache is not None:
+                cache.close()
 
     # CSV only cluster > 1 are written down
     write_identical_sequences(clusters, basename, args.output_prefix)
 
     # Unique representatives FASTA
-    write_unique_fasta(clusters, args.input, basename,  args.output_prefix)
+    if args.threshold != 1.0:
+        write_unique_fasta(clusters, args.input, basename,  args.output_prefix)
 
     # json output
 
@@ -153,7 +565,8 @@ def main():
                         segment_name = args.segment_name,
                         file_prefix=  args.output_prefix,
                         basename = basename,
-                        threshold = args.threshold)
+                        threshold = args.threshold,
+                        cache_stats = cache.stats() if cache is not None else None)
 
 if __name__ == "__main__":
     main()
@@ -1,128 +1,496 @@
 from Bio import SeqIO
 import click
-from collections import Counter
-from typing import Dict, Tuple, Any, List
+from typing import Any, Dict, Iterator, Tuple, List
+import hashlib
+import json
 import logging
-from multiprocessing import Pool
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def extract_region_from_alignment(fasta_file:str,
-                                  start:int,
-                                  end:int,
-                                  gene_name,
-                                  max_gap:int,  gene_dict:Dict)-> List[Tuple[Dict[str, str], Dict[str, List]]]:
-    """
-    Extracts the region between positions start and end from all sequences in a FASTA alignment.
+# per-site counts are kept for these symbols, anything else goes to the OTHER column
+ALPHABET = b"acgtn-"
+A, C, G, T, N, GAP = range(len(ALPHABET))
+OTHER = len(ALPHABET)
+SYMBOL_INDEX = np.full(256, OTHER, dtype=np.uint8)
+for _index, _symbol in enumerate(ALPHABET):
+    SYMBOL_INDEX[_symbol] = _index
+    SYMBOL_INDEX[ord(chr(_symbol).upper())] = _index
+# default number of alignment columns counted at once, bounds the temporary buffers
+COLUMN_CHUNK = 65536
 
-    :param fasta_file: Path to the input FASTA file.
-    :param start: Start position (1-based index).
-    :param end: End position (1-based index, inclusive).
-    :param gene_dict: Dictionary holding updated alignment without constant sites
+
+def _alignment_rows(fasta_file: str) -> Iterator[Tuple[str, np.ndarray]]:
     """
-    gene_temporal_dict = {}
-    gene_constant_sites = {}
+    Yields (id, lower-cased uint8 row) for each sequence, checking all have the same length.
+    """
+    width = None
     with open(fasta_file, "r") as input_handle:
         for record in SeqIO.parse(input_handle, "fasta"):
-            extracted_seq = record.seq[start:end]
-            gene_temporal_dict[record.id] = str(extracted_seq).lower()
+            row = np.frombuffer(str(record.seq).lower().encode("ascii"), dtype=np.uint8)
+            if width is None:
+                width = row.size
+            elif row.size != width:
+                raise ValueError(f"Sequences in {fasta_file} are not aligned (different lengths)")
+            yield record.id, row
 
-    # If any sequence for a given gene contains too many gaps,
-    # exclude that gene from the analysis by returning an empty dict with the same keys.
-    for key, value in gene_temporal_dict.items():
-        if value.count("-") / len(value) > max_gap:
-            return {key: "" for key in gene_temporal_dict}, {gene_name:[0, 0, 0, 0]}
 
-    #  remove constant sites
-    # gene_temporal_dict = remove_constant_sites(gene_temporal_dict)
-    # to calculate values for ASC_STAM correction for a gene
-    gene_constant_sites[gene_name] = count_constant_for_dict(gene_temporal_dict)
-    # remove non-SNPs from the alignment
-    gene_temporal_dict = remove_constant_sites_amd_indels(gene_temporal_dict)
-    gene_dict[gene_name] = gene_temporal_dict
-    return  gene_dict, gene_constant_sites
+def read_alignment(fasta_file: str) -> Tuple[List[str], np.ndarray]:
+    """
+    Reads a FASTA alignment once into a lower-cased samples x sites uint8 matrix.
+
+    :param fasta_file: Path to the input FASTA file.
+    :return: list of sequence ids (in file order) and the alignment matrix
+    """
+    ids = []
+    rows = []
+    for sample_id, row in _alignment_rows(fasta_file):
+        ids.append(sample_id)
+        rows.append(row)
+    if not rows:
+        return ids, np.empty((0, 0), dtype=np.uint8)
+    return ids, np.vstack(rows)
 
 
-def remove_constant_sites(slownik_alignmentu:Dict) -> Dict:
+def memmap_alignment(fasta_file: str, memmap_dir: str) -> Tuple[List[str], np.ndarray]:
     """
-    Funkcja usuwa z alignmentu te pozycje w ktorym sa albo te same nuklotydy + ewenutalne N-ki
-    :param slownik_alignmentu: slownik z alignmentem
-    :return:
+    Converts a FASTA alignment into a fixed-width on-disk uint8 matrix and maps it read-only.
+
+    Only one sequence is held in memory at a time. The backing file is unlinked as soon
+    as it is mapped, so it does not outlive the process.
+
+    :param fasta_file: Path to the input FASTA file.
+    :param memmap_dir: directory for the temporary matrix file
+    :return: list of sequence ids (in file order) and the memory-mapped alignment matrix
     """
-    position_counts = [Counter(bases) for bases in zip(*list(slownik_alignmentu.values()))]
-    positions_to_keep = [i for i, counter in enumerate(position_counts) if ((len(counter.keys()) > 2) or(len(counter.keys()) == 2 and  "n" not in counter.keys()))]
-    slownik_alignmentu_out = {key: ''.join(val[i] for i in positions_to_keep) for key, val in slownik_alignmentu.items()}
+    ids = []
+    width = 0
+    handle, matrix_path = tempfile.mkstemp(suffix=".u8", dir=memmap_dir)
+    try:
+        with os.fdopen(handle, "wb") as output_handle:
+            for sample_id, row in _alignment_rows(fasta_file):
+                ids.append(sample_id)
+                width = row.size
+                output_handle.write(row.tobytes())
+        if not ids or width == 0:
+            return ids, np.empty((len(ids), 0), dtype=np.uint8)
+        return ids, np.memmap(matrix_path, dtype=np.uint8, mode="r", shape=(len(ids), width))
+    finally:
+        os.remove(matrix_path)
+
+
+def _embl_feature(location: str, label: str) -> Tuple[str, int, int]:
+    positions = [int(position) for position in re.findall(r"\d+", location)]
+    if not positions:
+        raise ValueError(f"Cannot parse EMBL feature location {location!r}")
+    if label is None:
+        raise ValueError(f"EMBL feature at {location} has no /label qualifier")
+    return label, min(positions) - 1, max(positions)
+
+
+def read_embl_features(embl_file: str) -> np.ndarray:
+    """
+    Reads features of an EMBL file (e.g. Roary core_alignment_header.embl) from its FT lines only.
 
-    return slownik_alignmentu_out
+    A feature spans from its lowest to its highest location coordinate, which matches
+    Biopython's location.start/location.end for the simple, complement and join
+    locations written by Roary. Reading stops at the sequence (SQ) section.
 
-def count_constant_sites(plik_alignment:str) -> List[Any]:
+    :param embl_file: path to the EMBL file
+    :return: structured array with fields name (/label qualifier), start (0-based)
+             and end (exclusive), in file order
     """
-    Calculates number of constant sites in an alignment
-    Returns a list of 4 ints number of constant sites with A, T, G and C
-    :param slownik_alignmentu: slownik z alignmentem
-    :return:
+    features = []
+    location, label, in_location = None, None, False
+    with open(embl_file, "r") as input_handle:
+        for line in input_handle:
+            if line.startswith(("SQ", "//")):
+                break
+            if not line.startswith("FT"):
+                continue
+            key, value = line[5:21].strip(), line[21:].strip()
+            if key:
+                if location is not None:
+                    features.append(_embl_feature(location, label))
+                location, label, in_location = value, None, True
+            elif value.startswith("/"):
+                in_location = False
+                if value.startswith("/label=") and label is None:
+                    label = value[len("/label="):].strip('"')
+            elif in_location:
+                location += value
+    if location is not None:
+        features.append(_embl_feature(location, label))
+    width = max([len(name) for name, _, _ in features], default=1)
+    return np.array(features, dtype=[("name", f"U{width}"), ("start", np.int64), ("end", np.int64)])
+
+
+def count_sites(matrix: np.ndarray, chunk_size: int = COLUMN_CHUNK) -> Tuple[np.ndarray, np.ndarray]:
     """
-    A, T, G, C = 0, 0, 0, 0
-    temporal_dict = {}
-    with open(plik_alignment, "r") as input_handle:
-        for record in SeqIO.parse(input_handle, "fasta"):
-            temporal_dict[record.id] = str(record.seq).upper()
+    Counts every symbol of ALPHABET in every alignment column.
+
+    Columns are processed in chunks of chunk_size, so for a memory-mapped matrix only
+    samples x chunk_size bytes are paged in at once. Symbols outside ALPHABET
+    (e.g. IUPAC ambiguity codes) are pooled in the OTHER column, so the number of
+    distinct such symbols is returned separately, capped at 2 which is all the
+    variable-site rule needs to tell apart.
+
+    :param matrix: samples x sites alignment
+    :param chunk_size: number of columns processed at once
+    :return: (sites x len(ALPHABET) + 1) array of counts and per-site number of
+             distinct symbols from outside ALPHABET
+    """
+    n_sites = matrix.shape[1]
+    counts = np.zeros((n_sites, OTHER + 1), dtype=np.int32)
+    other_kinds = np.zeros(n_sites, dtype=np.int8)
+    for start in range(0, n_sites, chunk_size):
+        end = min(start + chunk_size, n_sites)
+        block = np.asarray(matrix[:, start:end])
+        codes = SYMBOL_INDEX[block]
+        for symbol in range(OTHER + 1):
+            counts[start:end, symbol] = np.count_nonzero(codes == symbol, axis=0)
+        if counts[start:end, OTHER].any():
+            is_other = codes == OTHER
+            lowest = np.where(is_other, block, 255).min(axis=0)
+            highest = np.where(is_other, block, 0).max(axis=0)
+            other_kinds[start:end] = (counts[start:end, OTHER] > 0).astype(np.int8) + (lowest < highest)
+    return counts, other_kinds
+
+
+def classify_sites(counts: np.ndarray, other_kinds: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Derives site masks from per-site symbol counts.
+
+    A site is variable if it has no gap and either more than two distinct symbols
+    or two distinct symbols none of which is an "n". A site is constant if it holds
+    a single nucleotide in all samples.
+
+    :param counts: per-site symbol counts from count_sites
+    :param other_kinds: per-site number of distinct symbols outside ALPHABET
+    :return: variable mask, indel mask and per-site index (0-3 for A, C, G, T) of
+             the constant base, -1 for sites that are not constant
+    """
+    distinct = np.count_nonzero(counts[:, :OTHER], axis=1) + other_kinds
+    indel = counts[:, GAP] > 0
+    variable = ~indel & ((distinct > 2) | ((distinct == 2) & (counts[:, N] == 0)))
+    single_base = (distinct == 1) & (counts[:, A:T + 1] > 0).any(axis=1)
+    constant = np.where(single_base, np.argmax(counts[:, A:T + 1], axis=1), -1).astype(np.int8)
+    return variable, indel, constant
+
+
+def constant_site_counts(constant: np.ndarray, start: int = 0, end: int = None) -> List[int]:
+    """
+    Returns numbers of constant A, C, G and T sites, as used by ASC_STAM.
+
+    :param constant: per-site constant base index from classify_sites
+    :param start: Start position (0-based index).
+    :param end: End position (0-based, exclusive), defaults to the alignment end.
+    """
+    region = constant[start:end]
+    return np.bincount(region[region >= 0], minlength=4).tolist()
+
+
+def parsimony_informative_sites(counts: np.ndarray) -> np.ndarray:
+    """
+    Marks sites where at least two nucleotides each occur in at least two samples.
+
+    :param counts: per-site symbol counts from count_sites
+    """
+    return np.count_nonzero(counts[:, A:T + 1] >= 2, axis=1) >= 2
+
+
+def fold_into_constant(constant: np.ndarray, counts: np.ndarray, sites: np.ndarray) -> np.ndarray:
+    """
+    Returns a copy of constant in which the given sites count as constant sites of their majority nucleotide.
+
+    Used to keep ASC_STAM counts for variable sites that are dropped from the output
+    (e.g. parsimony-uninformative ones): a singleton site is treated as the invariant
+    site it would be without its single deviating sample. This is not a correction.
+    ASC_STAM assumes every variable site is in the alignment, which no longer holds
+    once sites are dropped, and RAxML has no exact correction for that case.
+
+    :param constant: per-site constant base index from classify_sites
+    :param counts: per-site symbol counts from count_sites
+    :param sites: mask of dropped sites
+    """
+    folded = constant.copy()
+    folded[sites] = np.argmax(counts[sites, A:T + 1], axis=1)
+    return folded
+
+
+def unique_site_patterns(matrix: np.ndarray, columns: np.ndarray,
+                         chunk_size: int = COLUMN_CHUNK) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds distinct site patterns among the given alignment columns.
+
+    Columns are compared by a 128-bit digest of their content, chunk_size columns at a time.
+
+    :param matrix: samples x sites alignment
+    :param columns: indices of the alignment columns to compress
+    :param chunk_size: number of columns gathered at once
+    :return: positions within columns of the first occurrence of every distinct pattern,
+             in order, and the number of columns sharing each pattern
+    """
+    slots = {}
+    first = []
+    weights = []
+    for offset in range(0, len(columns), chunk_size):
+        block = np.ascontiguousarray(matrix[:, columns[offset:offset + chunk_size]].T)
+        for position, pattern in enumerate(block, start=offset):
+            key = hashlib.blake2b(pattern.tobytes(), digest_size=16).digest()
+            slot = slots.get(key)
+            if slot is None:
+                slots[key] = len(first)
+                first.append(position)
+                weights.append(1)
+            else:
+                weights[slot] += 1
+    return np.array(first, dtype=np.int64), np.array(weights, dtype=np.int64)
 
-    position_counts = [Counter(bases) for bases in zip(*list(temporal_dict.values()))]
 
-    for counter in position_counts:
-        if len(counter.keys()) == 1 and list(counter.keys())[0] == "A":
-            A += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "T":
-            T += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "G":
-            G += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "C":
-            C += 1
+def gene_is_gapped(matrix: np.ndarray, start: int, end: int, max_gap: float) -> bool:
+    """
+    Checks whether any sample has a gap fraction above max_gap within a gene.
+
+    :param matrix: lower-cased samples x sites alignment
+    :param start: Start position (0-based index).
+    :param end: End position (0-based, exclusive).
+    :param max_gap: maximal allowed fraction of gaps in a sample
+    """
+    region = matrix[:, start:end]
+    gaps = np.count_nonzero(region == ALPHABET[GAP], axis=1)
+    return bool((gaps / region.shape[1] > max_gap).any())
 
 
-    return [A, C, G, T]
+def gene_columns(variable: np.ndarray, constant: np.ndarray, start: int, end: int,
+                 excluded: bool) -> Tuple[np.ndarray, List[int]]:
+    """
+    Returns variable column indices and ASC_STAM constant-site counts for a gene.
 
+    Genes in which any sample exceeds max_gap are excluded, i.e. they contribute
+    no columns and zero constant sites.
 
-def count_constant_for_dict(slownik_alignmentu: Dict) -> List[Any]:
+    :param variable: mask of variable sites from classify_sites
+    :param constant: constant base index per site from classify_sites
+    :param start: Start position (0-based index).
+    :param end: End position (0-based, exclusive).
+    :param excluded: whether the gene failed the max_gap filter
+    :return: indices of variable columns and a list of constant A, C, G and T sites
     """
-    Calculates number of constant sites in an alignment
-    Returns a list of 4 ints number of constant sites with A, T, G and C
-    :param slownik_alignmentu: slownik z alignmentem
-    :return:
+    if excluded:
+        return np.empty(0, dtype=np.int64), [0, 0, 0, 0]
+    return start + np.flatnonzero(variable[start:end]), constant_site_counts(constant, start, end)
+
+
+# (matrix, max_gap) read by the *_task functions; forked workers inherit it
+_task_input = None
+
+
+def _count_sites_task(task: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    matrix, _ = _task_input
+    start, end = task
+    return count_sites(matrix[:, start:end], chunk_size=end - start)
+
+
+def _gapped_genes_task(task: List[Tuple[int, int]]) -> np.ndarray:
+    matrix, max_gap = _task_input
+    return np.array([gene_is_gapped(matrix, start, end, max_gap) for start, end in task], dtype=bool)
+
+
+def _gene_batches(genes: List[Tuple[int, int]], batch_sites: int) -> List[List[Tuple[int, int]]]:
+    """
+    Groups consecutive genes until they span at least batch_sites columns, so short
+    genes are checked in one task instead of one task each.
+    """
+    batches, batch, sites = [], [], 0
+    for start, end in genes:
+        batch.append((start, end))
+        sites += end - start
+        if sites >= batch_sites:
+            batches.append(batch)
+            batch, sites = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def analyse_alignment(matrix: np.ndarray, genes: List[Tuple[int, int]], max_gap: float, cpus: int,
+                      chunk_size: int = COLUMN_CHUNK) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts sites (see count_sites) and applies the max_gap filter to every gene.
+
+    Work is split into column chunks and batches of genes spanning about as many
+    columns, given only as (start, end) ranges. With several CPUs the tasks run in forked workers that read the
+    alignment (in memory or memory-mapped) in place, and only compact counts and
+    flags are sent back.
+
+    :param matrix: lower-cased samples x sites alignment
+    :param genes: (start, end) 0-based, end-exclusive gene ranges
+    :param max_gap: maximal allowed fraction of gaps in a sample
+    :param cpus: number of worker processes
+    :param chunk_size: number of columns counted per task
+    :return: per-site counts, per-site number of distinct symbols outside ALPHABET
+             and a per-gene mask of genes excluded by max_gap
+    """
+    global _task_input
+    n_sites = matrix.shape[1]
+    column_tasks = [(start, min(start + chunk_size, n_sites)) for start in range(0, n_sites, chunk_size)]
+    gene_tasks = _gene_batches(genes, chunk_size)
+
+    _task_input = (matrix, max_gap)
+    try:
+        if cpus == 1 or "fork" not in multiprocessing.get_all_start_methods():
+            site_results = list(map(_count_sites_task, column_tasks))
+            gene_results = list(map(_gapped_genes_task, gene_tasks))
+        else:
+            with multiprocessing.get_context("fork").Pool(cpus) as pool:
+                site_results = pool.map(_count_sites_task, column_tasks, chunksize=1)
+                gene_results = pool.map(_gapped_genes_task, gene_tasks, chunksize=1)
+    finally:
+        _task_input = None
+
+    if site_results:
+        counts = np.concatenate([result[0] for result in site_results])
+        other_kinds = np.concatenate([result[1] for result in site_results])
+    else:
+        counts, other_kinds = count_sites(matrix)
+    gapped = np.concatenate(gene_results) if gene_results else np.zeros(0, dtype=bool)
+    return counts, other_kinds, gapped
+
+
+def write_snp_alignment(output_fasta: str, sample_ids: List[str], matrix: np.ndarray, columns: np.ndarray) -> None:
     """
-    A, T, G, C = 0, 0, 0, 0
+    Writes the selected alignment columns as FASTA, one buffered write per sample.
 
-    slownik_alignmentu_tmp = {}
-    for key, value in slownik_alignmentu.items():
-        slownik_alignmentu_tmp[key] = value.upper()
+    :param output_fasta: path to the output FASTA
+    :param sample_ids: sequence ids in matrix row order
+    :param matrix: samples x sites alignment
+    :param columns: indices of the alignment columns to keep, in output order
+    """
+    with open(output_fasta, "wb") as output_handle:
+        for sample_id, row in zip(sample_ids, matrix):
+            output_handle.write(b">" + sample_id.encode() + b"\n" + row[columns].tobytes() + b"\n")
 
-    position_counts = [Counter(bases) for bases in zip(*list(slownik_alignmentu_tmp.values()))]
 
-    for counter in position_counts:
-        if len(counter.keys()) == 1 and list(counter.keys())[0] == "A":
-            A += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "T":
-            T += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "G":
-            G += 1
-        elif len(counter.keys()) == 1 and list(counter.keys())[0] == "C":
-            C += 1
+def write_site_map(output_site_map: str, columns: np.ndarray, column_genes: np.ndarray,
+                   reference: np.ndarray) -> None:
+    """
+    Writes the map from SNP alignment columns back to the core alignment.
 
-    return [A, C, G, T]
+    Row i describes SNP column i + 1: its 1-based position in the core alignment,
+    the gene it belongs to and the base of the first sequence (reference). A path
+    ending with .npy gets a structured array that can be opened with
+    np.load(path, mmap_mode="r"), anything else a tab-separated table.
 
-def remove_constant_sites_amd_indels(slownik_alignmentu:Dict) -> Dict:
+    :param output_site_map: path to the output file
+    :param columns: 0-based core alignment indices of the SNP columns, in output order
+    :param column_genes: gene name of every SNP column
+    :param reference: first sequence of the alignment
     """
-    Funkcja usuwa z alignmentu te pozycje w ktorym sa albo te same nuklotydy + ewenutalne N-ki
-    :param slownik_alignmentu: slownik z alignmentem
-    :return:
+    width = max([len(name) for name in column_genes], default=1)
+    site_map = np.zeros(len(columns), dtype=[("position", np.int64), ("gene", f"U{width}"), ("reference", "S1")])
+    site_map["position"] = columns + 1
+    site_map["gene"] = column_genes
+    site_map["reference"] = reference[columns].view("S1") if len(columns) else []
+    if output_site_map.endswith(".npy"):
+        with open(output_site_map, "wb") as output_handle:
+            np.save(output_handle, site_map)
+        return
+    with open(output_site_map, "w") as output_handle:
+        output_handle.write("snp_column\tposition\tgene\treference\n")
+        for snp_column, (position, gene, base) in enumerate(site_map.tolist(), start=1):
+            output_handle.write(f"{snp_column}\t{position}\t{gene}\t{base.decode()}\n")
+
+
+# bump when the layout of cached outputs or the meaning of an option changes
+CACHE_VERSION = 1
+
+
+def input_fingerprint(paths: List[str], settings: Dict[str, Any]) -> str:
+    """
+    Hashes the content of the input files together with the settings that affect the outputs.
+
+    :param paths: input files, hashed in the given order
+    :param settings: option values, hashed in sorted key order
+    :return: hex digest used as the cache key
     """
-    position_counts = [Counter(bases) for bases in zip(*list(slownik_alignmentu.values()))]
-    positions_to_keep = [i for i, counter in enumerate(position_counts) if ((len(counter.keys()) > 2 and "-" not in counter.keys())
-                                                                            or (len(counter.keys()) == 2 and "n" not in counter.keys()) and "-" not in counter.keys())]
-    slownik_alignmentu_out = {key: ''.join(val[i] for i in positions_to_keep) for key, val in slownik_alignmentu.items()}
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps({"version": CACHE_VERSION, **settings}, sort_keys=True).encode())
+    for path in paths:
+        with open(path, "rb") as input_handle:
+            for block in iter(lambda: input_handle.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def fetch_from_cache(cache_dir: str, key: str, outputs: Dict[str, str]) -> bool:
+    """
+    Copies cached outputs for key to their destinations and marks the entry as recently used.
+
+    :param cache_dir: cache directory
+    :param key: cache key from input_fingerprint
+    :param outputs: cached file name -> destination path
+    :return: True on a cache hit
+    """
+    entry = os.path.join(cache_dir, key)
+    if not all(os.path.isfile(os.path.join(entry, name)) for name in outputs):
+        return False
+    try:
+        for name, destination in outputs.items():
+            shutil.copyfile(os.path.join(entry, name), destination)
+        os.utime(entry)
+    except OSError:
+        # the entry was evicted by a concurrent run in the meantime
+        return False
+    return True
+
+
+def store_in_cache(cache_dir: str, key: str, outputs: Dict[str, str], max_bytes: int) -> None:
+    """
+    Stores outputs under key and evicts least recently used entries beyond max_bytes.
+
+    The entry is assembled in a temporary directory and renamed into place, so
+    concurrent runs never see a partial entry.
+
+    :param cache_dir: cache directory
+    :param key: cache key from input_fingerprint
+    :param outputs: cached file name -> path of the freshly written output
+    :param max_bytes: total size the cache is trimmed to
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    for name, source in outputs.items():
+        shutil.copyfile(source, os.path.join(staging, name))
+    try:
+        os.rename(staging, os.path.join(cache_dir, key))
+    except OSError:
+        # another run stored the same key in the meantime
+        shutil.rmtree(staging)
+    evict_cache(cache_dir, max_bytes)
+
+
+def evict_cache(cache_dir: str, max_bytes: int) -> None:
+    """
+    Removes least recently used cache entries until their total size is at most max_bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith("."):
+            size = sum(item.stat().st_size for item in os.scandir(entry.path) if item.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
 
-    return slownik_alignmentu_out
 
 @click.command()
 @click.option('--input_fasta', help='[INPUT] a fasta of concatated core genes sequences from Roary',
@@ -139,63 +507,123 @@ def remove_constant_sites_amd_indels(slownik_alignmentu:Dict) -> Dict:
 @click.option('--output_partition', help='[OUTPUT] a partition file for raxml program',
               type=str, required=True)
 @click.option('--cpus', help='[INPUT] a number of cpus to use',
-              type=int, required=False, default=1)
+              type=click.IntRange(min=1), required=False, default=1)
 @click.option('--merge_genes', help='[INPUT] In partition collapse all entries into single row and add "global" '
                               'ASC_STAM correction',is_flag=True)
+@click.option('--memmap_dir', help='[INPUT] If set, the alignment is converted into a temporary on-disk matrix in '
+                                   'this directory and processed in column chunks, so memory use no longer grows '
+                                   'with samples x alignment length',
+              type=click.Path(exists=True, file_okay=False), required=False, default=None)
+@click.option('--chunk_size', help='[INPUT] Number of alignment columns processed at once',
+              type=click.IntRange(min=1), required=False, default=COLUMN_CHUNK)
+@click.option('--informative_only', help='[INPUT] Keep only parsimony-informative sites. Dropped variable sites are '
+                                         'added to the ASC_STAM counts of their majority nucleotide. This breaks '
+                                         'the assumption of ASC_STAM that all variable sites are in the alignment, '
+                                         'so the ascertainment bias correction is no longer exact',
+              is_flag=True)
+@click.option('--compress_patterns', help='[INPUT] Keep a single column for each distinct site pattern within a '
+                                          'partition and write the pattern counts to --output_weights',
+              is_flag=True)
+@click.option('--output_weights', help='[OUTPUT] a site weights file for raxml-ng --site-weights, '
+                                       'required with --compress_patterns',
+              type=str, required=False, default=None)
+@click.option('--cache_dir', help='[INPUT] Directory with outputs of previous runs. Outputs are reused when the '
+                                  'input files and all options affecting the outputs are unchanged',
+              type=click.Path(file_okay=False), required=False, default=None)
+@click.option('--cache_max_mb', help='[INPUT] Total size of --cache_dir in MB, least recently used entries '
+                                     'are removed above it',
+              type=click.IntRange(min=0), required=False, default=10240)
+@click.option('--output_site_map', help='[OUTPUT] Optional map of SNP alignment columns to core alignment positions, '
+                                        'genes and bases of the first sequence; a .npy structured array if the '
+                                        'name ends with .npy, a tsv otherwise',
+              type=str, required=False, default=None)
+
+def main(input_fasta, input_fasta_annotation, model, output_fasta, max_gap, output_partition, merge_genes, cpus,
+         memmap_dir, chunk_size, informative_only, compress_patterns, output_weights, cache_dir, cache_max_mb,
+         output_site_map) -> None:
+    if compress_patterns and not output_weights:
+        raise click.UsageError("--compress_patterns requires --output_weights")
+
+    outputs = {"alignment_SNPs.fasta": output_fasta, "partition.txt": output_partition}
+    if compress_patterns:
+        outputs["site_weights.txt"] = output_weights
+    if output_site_map:
+        outputs["site_map.npy" if output_site_map.endswith(".npy") else "site_map.tsv"] = output_site_map
+    if cache_dir:
+        cache_key = input_fingerprint([input_fasta, input_fasta_annotation],
+                                      {"model": model, "max_gap": max_gap, "merge_genes": merge_genes,
+                                       "informative_only": informative_only, "compress_patterns": compress_patterns,
+                                       "outputs": sorted(outputs)})
+        if fetch_from_cache(cache_dir, cache_key, outputs):
+            logging.info(f"Reusing cached outputs {cache_key} from {cache_dir}")
+            evict_cache(cache_dir, cache_max_mb * 1024 * 1024)
+            return
 
-def main(input_fasta, input_fasta_annotation, model, output_fasta, max_gap, output_partition, merge_genes, cpus) -> None:
-    alignment_dict = {}
     ASAM_correction = {}
-    pool = Pool(cpus)
-    jobs = []
-    gen_list = []
+    gene_indices = {}
+
+    # the alignment is parsed once and all sites are classified in a single pass,
+    # per-gene results are just index ranges into the precomputed masks
+    if memmap_dir:
+        sample_ids, matrix = memmap_alignment(input_fasta, memmap_dir)
+    else:
+        sample_ids, matrix = read_alignment(input_fasta)
+
+    features = read_embl_features(input_fasta_annotation)
+    gen_list = features["name"].tolist()
+    genes = list(zip(features["start"].tolist(), features["end"].tolist()))
+
+    counts, other_kinds, gapped = analyse_alignment(matrix, genes, max_gap, cpus, chunk_size)
+    variable, _, constant = classify_sites(counts, other_kinds)
+    if informative_only:
+        informative = parsimony_informative_sites(counts)
+        constant = fold_into_constant(constant, counts, variable & ~informative)
+        variable &= informative
 
     # Count constant sites
-
-    global_STAM_values = count_constant_sites(plik_alignment=input_fasta)
-
-    with open(input_fasta_annotation, "r") as input_annotation_handle:
-        record = SeqIO.read(input_annotation_handle, "embl")  # Read the first record
-        for feature in record.features:
-            start = int(feature.location.start)
-            end = int(feature.location.end)
-            gene_name = feature.qualifiers["label"][0]
-            gen_list.append(gene_name)
-            #  print(f'Sending to pool for gen {gene_name}, {start}, {end}')
-            jobs.append(pool.apply_async(extract_region_from_alignment, (input_fasta, start, end, gene_name, max_gap, alignment_dict)))
-
-    # wykonujemy zadania asynchronicznie
-
-    for job in jobs:
-        alignment_dict = {**alignment_dict, **job.get()[0]}
-        ASAM_correction = {**ASAM_correction, **job.get()[1]}
-    pool.close()
-
-    alignment_dict_final = {}
-    old_end = 0
+    global_STAM_values = constant_site_counts(constant)
+
+    for gene_name, (start, end), excluded in zip(gen_list, genes, gapped):
+        gene_indices[gene_name], ASAM_correction[gene_name] = gene_columns(variable, constant, start, end, excluded)
+
+    # identical columns are only merged within a partition, weights follow the output column order
+    weights = []
+    if compress_patterns and not merge_genes:
+        for gen in gen_list:
+            first, gene_weights = unique_site_patterns(matrix, gene_indices[gen], chunk_size)
+            gene_indices[gen] = gene_indices[gen][first]
+            weights.append(gene_weights)
+
+    # let the final alignment and partition file retain order from roary output,
+    # partition boundaries follow from cumulative per-gene numbers of variable sites
+    gene_lengths = [len(gene_indices[gen]) for gen in gen_list]
+    gene_ends = np.cumsum(gene_lengths, dtype=np.int64)
+    old_end = int(gene_ends[-1]) if gen_list else 0
     partition_dict = {}
-
-    # let the final alignment and partition file retain order from roary output
-    for gen in gen_list:
-        for sample_id, sekwencja in alignment_dict[gen].items():
-            if sample_id not in alignment_dict_final.keys():
-                alignment_dict_final[sample_id] = sekwencja
-            else:
-                alignment_dict_final[sample_id] += sekwencja
+    for gen, length, gene_end in zip(gen_list, gene_lengths, gene_ends.tolist()):
         #  add to partition data inf regarding genes that after
         #  removal of constant sites still have non-0 length
-        if len(sekwencja) > 0:
-            partition_dict[gen] = [old_end+1, old_end + len(sekwencja)]
-            old_end = old_end + len(sekwencja)
-
+        if length > 0:
+            partition_dict[gen] = [gene_end - length + 1, gene_end]
         else:
             logging.info(f"{gen} has no variable positions among analyzed samples")
 
-
     #  dump new alignment to fasta file
-    with open(output_fasta, "w") as output_handle:
-        for klucz,wartosc in alignment_dict_final.items():
-            output_handle.write(f">{klucz}\n{wartosc}\n")
+    columns = np.concatenate([gene_indices[gen] for gen in gen_list]) if gen_list else np.empty(0, dtype=np.int64)
+    column_genes = np.repeat(np.array(gen_list, dtype=str), gene_lengths)
+    if compress_patterns and merge_genes:
+        first, genome_weights = unique_site_patterns(matrix, columns, chunk_size)
+        columns = columns[first]
+        column_genes = column_genes[first]
+        weights.append(genome_weights)
+        old_end = len(columns)
+    write_snp_alignment(output_fasta, sample_ids, matrix, columns)
+    if output_site_map:
+        write_site_map(output_site_map, columns, column_genes, matrix[0] if len(sample_ids) else np.empty(0, np.uint8))
+
+    if compress_patterns:
+        with open(output_weights, "w") as output_handle:
+            output_handle.write(" ".join(map(str, np.concatenate(weights).tolist() if weights else [])) + "\n")
 
     #  dump new partition into a file and add ASM correction to the user-specified model
     #  propably only if snp tree is provided as parameter (TO DO)ls -
@@ -211,6 +639,8 @@ def main(input_fasta, input_fasta_annotation, model, output_fasta, max_gap, outp
             last_gen = gen_list[-1]
             output_handle.write(f"{model}+{STAM_correction}, full_genome=1-{old_end}\n")
 
+    if cache_dir:
+        store_in_cache(cache_dir, cache_key, outputs, cache_max_mb * 1024 * 1024)
 
     #  Obsole, added ASM for each gene partition file
     # with open("constant_sites.txt", "w") as output_handle:
@@ -197,6 +197,7 @@ process prepare_SNPs_alignment {
     # --merge_genes partition file wont have many entries, one for each gene, but rather a single entry
     # for an entire genome + total number of constant sites observed in the initial alignment
     # this significantly speeds up the calculations by raxml as there are no partitions
+    # --memmap_dir keeps the alignment in a temporary on-disk matrix so memory does not scale with samples x genome length
     python /opt/docker/custom_scripts/prep_SNPs_alignment_and_partition.py --input_fasta ${fasta} \
                                                                            --input_fasta_annotation ${embl} \
                                                                            --model ${params.model} \
@@ -204,6 +205,7 @@ process prepare_SNPs_alignment {
                                                                            --output_partition partition.txt \
                                                                            --cpus ${task.cpus} \
                                                                            --max_gap 30 \
+                                                                           --memmap_dir . \
                                                                            --merge_genes
 
     """
@@ -632,7 +634,7 @@ process prepare_MST {
 
     tag "Preparing minimum spanning tree"
     cpus { params.threads > 10 ? 10 : params.threads }
-    memory "120 GB" 
+    memory "20 GB"
     time "30m"
     input:
     path(metadata)
@@ -657,6 +659,7 @@ process prepare_MST {
                                                                                   --plot ${params.results_prefix}_MST.html \
                                                                                   --output ${params.results_prefix}_distance.tsv \
                                                                                   --threads ${task.cpus} \
+                                                                                  --build-cache \
                                                                                   --color-by "HC5"
 
     """
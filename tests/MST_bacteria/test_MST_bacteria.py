@@ -1,14 +1,27 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
 import pytest
 import subprocess
+from scipy.spatial.distance import squareform
+import calculate_allelic_distance_and_plot_MST
 from calculate_allelic_distance_and_plot_MST import (
     calculate_distance,
     calculte_distance_matrix,
     calculate_mst,
-    load_profiles_to_dict,
+    load_profiles,
+    write_profile_cache,
+    profile_cache_is_fresh,
+    open_profiles,
+    write_profile_digests,
+    update_distance_matrix,
+    calculate_condensed_distances,
+    condensed_row,
     extract_profiles,
-    visualize_mst
+    visualize_mst,
+    equal_angle_layout,
+    hiercc_clusters,
 )
 
 # -------------------------------------------------------------------
@@ -16,17 +29,50 @@ from calculate_allelic_distance_and_plot_MST import (
 # -------------------------------------------------------------------
 
 
-def test_load_profiles_to_dict(tmp_path):
+def test_load_profiles(tmp_path):
     public_path = "profiles_test.list"
     local_path = "profiles_local_test.list"
 
-    pub_ST = load_profiles_to_dict(public_path)
-    local_ST = load_profiles_to_dict(local_path)
+    pub_alleles, pub_index = load_profiles(public_path)
+    local_alleles, local_index = load_profiles(local_path)
 
     # Verify allele vectors
-    np.testing.assert_array_equal(pub_ST['1'][:10], np.array(['1', 2., 3., 1., 3., 4., 3., 4., 3., 3.], dtype=object))
-    np.testing.assert_array_equal( local_ST['local_3'][:10], np.array(['local_3', 2., 34., 4., 10., 9., 12., 1., 16., 53.], dtype=object) )
+    assert pub_alleles.dtype == np.uint32
+    np.testing.assert_array_equal(pub_alleles[pub_index['1'], :9], [2, 3, 1, 3, 4, 3, 4, 3, 3])
+    np.testing.assert_array_equal(local_alleles[local_index['local_3'], :9], [2, 34, 4, 10, 9, 12, 1, 16, 53])
 
+    # Only requested STs are kept
+    sub_alleles, sub_index = load_profiles(public_path, selected_sts=['1', 'not_in_file'])
+    assert list(sub_index) == ['1']
+    assert sub_alleles.shape == (1, pub_alleles.shape[1])
+    np.testing.assert_array_equal(sub_alleles[0], pub_alleles[pub_index['1']])
+
+
+def test_profile_cache(tmp_path):
+    """The binary sidecar returns the same profiles as the text loader and is invalidated on change."""
+    profiles_path = tmp_path / "profiles.list"
+    profiles_path.write_text(open("profiles_test.list").read())
+    selected = ['3', 'missing', '1']
+
+    assert not profile_cache_is_fresh(str(profiles_path))
+    write_profile_cache(str(profiles_path))
+    assert profile_cache_is_fresh(str(profiles_path))
+
+    cached_alleles, cached_index = open_profiles(str(profiles_path), selected)
+    text_alleles, text_index = load_profiles(str(profiles_path), selected)
+    assert set(cached_index) == set(text_index) == {'1', '3'}
+    for st in cached_index:
+        np.testing.assert_array_equal(cached_alleles[cached_index[st]], text_alleles[text_index[st]])
+
+    # any modification of the source invalidates the sidecar
+    with open(profiles_path, "a") as f:
+        f.write("\n")
+    assert not profile_cache_is_fresh(str(profiles_path))
+
+    # rebuilding replaces the stale sidecar without leaving staging directories behind
+    write_profile_cache(str(profiles_path))
+    assert profile_cache_is_fresh(str(profiles_path))
+    assert sorted(os.listdir(tmp_path)) == ["profiles.list", "profiles.list.cache"]
 
 
 def test_extract_profiles(tmp_path):
@@ -38,37 +84,34 @@ def test_extract_profiles(tmp_path):
     local_path = "profiles_local_test.list"
 
     # --- Load both sets ---
-    pub_ST_dict = load_profiles_to_dict(public_path)
-    local_ST_dict = load_profiles_to_dict(local_path)
+    pub_ST = load_profiles(public_path)
+    local_ST = load_profiles(local_path)
 
     # --- Extract single STs ---
-    list_of_allels_public = extract_profiles(
-        profiles_public=pub_ST_dict, profiles_local=local_ST_dict, selected_sts=['1']
+    list_of_allels_public, labels_public = extract_profiles(
+        profiles_public=pub_ST, profiles_local=local_ST, selected_sts=['1']
     )
-    list_of_allels_local = extract_profiles(
-        profiles_public=pub_ST_dict, profiles_local=local_ST_dict, selected_sts=['local_3']
+    list_of_allels_local, labels_local = extract_profiles(
+        profiles_public=pub_ST, profiles_local=local_ST, selected_sts=['local_3']
     )
 
-    list_of_allels_both = extract_profiles(
-        profiles_public=pub_ST_dict, profiles_local=local_ST_dict, selected_sts=['1', 'local_3']
+    list_of_allels_both, labels_both = extract_profiles(
+        profiles_public=pub_ST, profiles_local=local_ST, selected_sts=['local_3', 'missing', '1']
     )
 
 
     # --- Verify content ---
-    np.testing.assert_array_equal(
-        list_of_allels_public[0, :10],
-        np.array(['1', 2., 3., 1., 3., 4., 3., 4., 3., 3.], dtype=object)
-    )
+    assert labels_public == ['1']
+    np.testing.assert_array_equal(list_of_allels_public[0, :9], [2, 3, 1, 3, 4, 3, 4, 3, 3])
 
-    np.testing.assert_array_equal(
-        list_of_allels_local[0, :10],
-        np.array(['local_3', 2., 34., 4., 10., 9., 12., 1., 16., 53.], dtype=object)
-    )
+    assert labels_local == ['local_3']
+    np.testing.assert_array_equal(list_of_allels_local[0, :9], [2, 34, 4, 10, 9, 12, 1, 16, 53])
 
+    assert labels_both == ['local_3', '1']
     np.testing.assert_array_equal(
-        list_of_allels_both[:2, :10],
-        np.array([['1', 2., 3., 1., 3., 4., 3., 4., 3., 3.],
-                  ['local_3', 2., 34., 4., 10., 9., 12., 1., 16., 53. ]], dtype=object)
+        list_of_allels_both[:2, :9],
+        np.array([[2, 34, 4, 10, 9, 12, 1, 16, 53],
+                  [2, 3, 1, 3, 4, 3, 4, 3, 3]])
     )
 
 
@@ -81,11 +124,11 @@ def test_calculate_distance_matrix_real_data(tmp_path):
     local_path = "profiles_local_test.list"
 
     # --- Load and merge ---
-    pub_ST = load_profiles_to_dict(public_path)
-    local_ST = load_profiles_to_dict(local_path)
-    all_STs = list(pub_ST.keys()) + list(local_ST.keys())
-    mat = extract_profiles(pub_ST, local_ST, all_STs)
-    mat = mat[0:9, :10]
+    pub_ST = load_profiles(public_path)
+    local_ST = load_profiles(local_path)
+    all_STs = list(pub_ST[1]) + list(local_ST[1])
+    mat, _ = extract_profiles(pub_ST, local_ST, all_STs)
+    mat = mat[0:9, :9]
 
 
     # --- Compute distance matrix ---
@@ -98,6 +141,116 @@ def test_calculate_distance_matrix_real_data(tmp_path):
     assert dist[6, 7] == 8
 
 
+def test_calculate_distance_matches_pairwise_formula(monkeypatch):
+    """
+    The blocked engine must reproduce the per-pair missing-loci correction
+    and int16 rounding exactly, including rows split across several blocks.
+    """
+    rng = np.random.default_rng(0)
+    alleles = rng.integers(0, 4, size=(25, 40)).astype(np.uint32)
+    alleles[rng.random(alleles.shape) < 0.2] = 0
+    mat = alleles
+
+    n_loci = alleles.shape[1]
+    expected = np.zeros((25, 25), dtype=np.int16)
+    for i in range(25):
+        for j in range(25):
+            x, y = alleles[i], alleles[j]
+            shared = (x > 0) & (y > 0)
+            al = 1e-4 + np.sum(shared)
+            ad = 1e-4 + np.sum(x[shared] != y[shared])
+            ll = max(np.sum(x > 0), np.sum(y > 0)) - 0.05 * n_loci
+            if ll > al:
+                ad += ll - al
+                al = ll
+            expected[i, j] = np.int16(ad / al * n_loci + 0.5)
+
+    np.testing.assert_array_equal(calculate_distance(mat, 0, 25), expected)
+
+    # force blocks of a few rows
+    monkeypatch.setattr(calculate_allelic_distance_and_plot_MST, "BLOCK_BYTES", 25 * 40 * 3)
+    np.testing.assert_array_equal(calculate_distance(mat, 3, 11), expected[3:11])
+
+
+def test_calculate_distance_matrix_shared_memory_workers():
+    """Workers writing into shared memory on the triangular schedule give the serial result."""
+    rng = np.random.default_rng(2)
+    mat = rng.integers(0, 4, size=(31, 20)).astype(np.uint32)
+    mat[rng.random(mat.shape) < 0.25] = 0
+    mat[4] = 0
+
+    serial = np.vstack([calculate_distance(mat, i, i + 1) for i in range(31)])
+    np.testing.assert_array_equal(calculte_distance_matrix(mat, cpus=1), serial)
+    np.testing.assert_array_equal(calculte_distance_matrix(mat, cpus=3), serial)
+    np.testing.assert_array_equal(calculte_distance_matrix(mat, cpus=3, rows=np.array([30, 2, 7])), serial[[30, 2, 7]])
+
+
+def test_condensed_distances_and_mst():
+    """Only pairs i < j are stored; the MST is the same for condensed and square input."""
+    rng = np.random.default_rng(3)
+    mat = rng.integers(0, 3, size=(15, 12)).astype(np.uint32)
+    labels = [f"ST{i}" for i in range(15)]
+    square = calculte_distance_matrix(mat, cpus=1)
+
+    condensed = calculate_condensed_distances(mat, cpus=2)
+    assert condensed.shape == (15 * 14 // 2,)
+    np.testing.assert_array_equal(condensed, squareform(square, checks=False))
+    np.testing.assert_array_equal(condensed_row(condensed, 15, 6), square[6])
+    np.testing.assert_array_equal(calculate_mst(condensed, labels), calculate_mst(square, labels))
+
+    # a k-NN candidate graph that contains every MST edge yields the same tree
+    np.testing.assert_array_equal(calculate_mst(condensed, labels, knn=14), calculate_mst(square, labels))
+    knn_edges = calculate_mst(condensed, labels, knn=2)
+    assert len(knn_edges) == len(calculate_mst(square, labels))
+
+
+def test_knn_mst_is_exact():
+    """A connected k-NN candidate graph can miss MST edges; the result still has the exact MST weight."""
+    labels = [f"ST{i}" for i in range(40)]
+    for seed in range(40):
+        mat = np.random.default_rng(seed).integers(0, 4, size=(40, 30)).astype(np.uint32)
+        condensed = calculate_condensed_distances(mat, cpus=1)
+        exact = calculate_mst(condensed, labels)
+        knn_edges = calculate_mst(condensed, labels, knn=2)
+        assert len(knn_edges) == len(exact)
+        assert sum(int(d) for _, _, d in knn_edges) == sum(int(d) for _, _, d in exact)
+
+
+def test_update_distance_matrix_reuses_previous_run(tmp_path):
+    """Splicing new STs into a previous matrix gives the same result as a full computation."""
+    rng = np.random.default_rng(1)
+    mat = rng.integers(0, 5, size=(12, 30)).astype(np.uint32)
+    labels = [str(i) for i in range(12)]
+    full = calculte_distance_matrix(mat, cpus=1)
+
+    previous_path = tmp_path / "previous.tsv"
+    old = [0, 2, 3, 5, 7, 8]
+    pd.DataFrame(full[np.ix_(old, old)], index=[labels[i] for i in old],
+                 columns=[labels[i] for i in old]).to_csv(previous_path, sep="\t")
+    write_profile_digests(str(previous_path), mat[old], [labels[i] for i in old], 0.05)
+
+    np.testing.assert_array_equal(squareform(update_distance_matrix(mat, labels, str(previous_path))), full)
+
+    # a changed profile of an old ST must not be taken from the previous matrix
+    changed = mat.copy()
+    changed[2] = changed[11]
+    np.testing.assert_array_equal(update_distance_matrix(changed, labels, str(previous_path)),
+                                  calculate_condensed_distances(changed, cpus=1))
+
+
+def test_hiercc_clusters_from_mst_edges():
+    """Clusters are MST components at each threshold, named after their smallest ST."""
+    edges = np.array([["10", "2", 3], ["2", "local_1", 7], ["local_1", "5", 12]], dtype=object)
+    labels = ["10", "2", "local_1", "5", "7"]
+    # "7" is identical to "5" (distance 0), which is never an MST edge
+    zero_pairs = (np.array([3]), np.array([4]))
+
+    clusters = hiercc_clusters(edges, labels, [10, 5], zero_pairs)
+
+    assert clusters[5] == {"10": "2", "2": "2", "local_1": "local_1", "5": "5", "7": "5"}
+    assert clusters[10] == {"10": "2", "2": "2", "local_1": "2", "5": "5", "7": "5"}
+
+
 def test_visualize_mst_runs(tmp_path):
     """Ensure MST visualization runs and produces an HTML file."""
     edges = np.array([["A", "B", 1], ["B", "C", 2]], dtype=object)
@@ -111,6 +264,66 @@ def test_visualize_mst_runs(tmp_path):
     assert out_html.exists()
     assert out_html.stat().st_size > 1000
 
+def test_equal_angle_layout():
+    """Every node of a forest gets a distinct position within [-1, 1]; edge lengths follow weights."""
+    import networkx as nx
+    G = nx.Graph()
+    G.add_edge("A", "B", weight=1)
+    G.add_edge("A", "C", weight=1)
+    G.add_edge("A", "D", weight=4)
+    G.add_edge("E", "F", weight=2)
+    pos = equal_angle_layout(G)
+
+    assert set(pos) == set(G.nodes())
+    xy = np.array(list(pos.values()))
+    assert np.abs(xy).max() <= 1.0 + 1e-9
+    assert len(np.unique(xy.round(6), axis=0)) == len(xy)
+    length = lambda u, v: np.hypot(*(pos[u] - pos[v]))
+    assert length("A", "D") == pytest.approx(4 * length("A", "B"))
+
+
+def test_equal_angle_layout_is_reproducible():
+    """Degree ties are broken in node order, so the layout does not depend on PYTHONHASHSEED."""
+    code = ("import networkx as nx\n"
+            "from calculate_allelic_distance_and_plot_MST import equal_angle_layout\n"
+            "G = nx.Graph()\n"
+            "G.add_weighted_edges_from([('1', '2', 1), ('2', '3', 2), ('3', '4', 1), ('5', '6', 3), ('6', '7', 1)])\n"
+            "print(sorted((n, xy.round(9).tolist()) for n, xy in equal_angle_layout(G).items()))\n")
+    layouts = set()
+    for seed in range(6):
+        env = dict(os.environ, PYTHONHASHSEED=str(seed))
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        layouts.add(result.stdout)
+    assert len(layouts) == 1
+
+
+def test_visualize_mst_equal_angle_layout(tmp_path):
+    edges = np.array([["A", "B", 1], ["B", "C", 2], ["B", "D", 70]], dtype=object)
+    out_html = tmp_path / "mst.html"
+    visualize_mst(edges, {"A": 1, "B": 2, "C": 1, "D": 1}, color_map={"A": "1", "B": "1", "C": "2", "D": "2"},
+                  color_label="HC10", output_html=str(out_html), sample_map={}, layout="equal-angle")
+    assert out_html.exists()
+
+
+def test_visualize_mst_webgl_shared_plotly_js(tmp_path):
+    """WebGL mode uses Scattergl with compact coordinates and references a shared plotly.js file."""
+    edges = np.array([["A", "B", 1], ["B", "C", 2]], dtype=object)
+    out_html = tmp_path / "reports" / "mst.html"
+    out_html.parent.mkdir()
+    shared_js = tmp_path / "plotly.min.js"
+    fig = visualize_mst(edges, {"A": 1, "B": 2, "C": 1}, color_map={"A": "1", "B": "1", "C": "2"},
+                        color_label="HC10", output_html=str(out_html), sample_map={},
+                        renderer="webgl", plotly_js=str(shared_js))
+
+    assert all(trace.type == "scattergl" for trace in fig.data)
+    assert np.asarray(fig.data[1].x).dtype == np.float32
+    assert shared_js.exists()
+    html = out_html.read_text()
+    assert 'src="../plotly.min.js"' in html
+    assert out_html.stat().st_size < shared_js.stat().st_size
+
+
 def test_end_to_end_script(tmp_path):
     """
     End-to-end test: simulate full workflow of cgMLST distance + MST generation.
@@ -122,11 +335,11 @@ def test_end_to_end_script(tmp_path):
     output_html = tmp_path / "mst_plot.html"
 
     # Step 1 — Load and merge
-    pub_ST = load_profiles_to_dict(public_path)
-    local_ST = load_profiles_to_dict(local_path)
-    all_STs = list(pub_ST.keys()) + list(local_ST.keys())
-    mat = extract_profiles(pub_ST, local_ST, all_STs)
-    mat_reduced = np.column_stack([mat[:, 0], mat[:, 1:10].astype(float)])
+    pub_ST = load_profiles(public_path)
+    local_ST = load_profiles(local_path)
+    all_STs = list(pub_ST[1]) + list(local_ST[1])
+    mat, _ = extract_profiles(pub_ST, local_ST, all_STs)
+    mat_reduced = mat[:, :9]
 
     # Step 2 — Compute allelic distances
     dist = calculte_distance_matrix(mat_reduced, cpus=1)
@@ -0,0 +1,10 @@
+# conftest.py
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark-scales", action="store", default=None,
+                     help="Comma separated benchmark scales to run (e.g. smoke,100x1Mb,2000x4Mb) or 'all', "
+                          "with their wall time and peak RSS checked; by default only the outputs of the "
+                          "smoke scale are checked")
+    parser.addoption("--update-baseline", action="store_true", default=False,
+                     help="Store measured metrics as the new baseline instead of comparing against it")
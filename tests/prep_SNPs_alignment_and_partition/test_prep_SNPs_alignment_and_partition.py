@@ -0,0 +1,177 @@
+"""
+Benchmarks for bin/prep_SNPs_alignment_and_partition.py.
+
+Synthetic Roary-like core alignments and EMBL headers are generated at several
+scales and the script is run as a subprocess. Wall time, peak RSS and hashes of
+the outputs are compared against benchmark_baseline.json; a run fails when the
+outputs change or a metric grows beyond the stored threshold.
+
+By default only the outputs of the "smoke" scale are checked. Wall time and peak
+RSS depend on the machine, so they are only compared for scales requested
+explicitly:
+
+    pytest --benchmark-scales 100x1Mb,500x1Mb
+    pytest --benchmark-scales all --update-baseline
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+SCRIPT = Path(__file__).resolve().parents[2] / "bin" / "prep_SNPs_alignment_and_partition.py"
+BASELINE = Path(__file__).resolve().parent / "benchmark_baseline.json"
+
+# name -> (samples, alignment length)
+SCALES = {
+    "smoke": (20, 100_000),
+    "100x1Mb": (100, 1_000_000),
+    "100x4Mb": (100, 4_000_000),
+    "500x1Mb": (500, 1_000_000),
+    "500x4Mb": (500, 4_000_000),
+    "2000x1Mb": (2000, 1_000_000),
+    "2000x4Mb": (2000, 4_000_000),
+}
+MODES = {
+    "memory": ["--merge_genes"],
+    "memmap": ["--merge_genes", "--memmap_dir", "{tmp}"],
+    "per_gene": [],
+}
+# relative growth allowed before a metric counts as a regression
+DEFAULT_THRESHOLDS = {"wall_time_s": 0.5, "peak_rss_mb": 0.25}
+# absolute slack for very short runs, where interpreter start-up dominates
+MIN_WALL_TIME_SLACK_S = 1.0
+
+
+def generate_core_alignment(fasta: Path, embl: Path, n_samples: int, length: int, seed: int = 0) -> None:
+    """
+    Writes a Roary-like core alignment (one sequence per line) and its EMBL header.
+
+    Genes are 300-1500 bp long, about 2% of sites are polymorphic and samples
+    carry occasional n, ambiguity codes and short gap runs so every site class
+    of the script is exercised. Sequences are generated one at a time.
+    """
+    rng = np.random.default_rng(seed)
+    nucleotides = np.frombuffer(b"ACGT", dtype=np.uint8)
+    reference = nucleotides[rng.integers(0, 4, length)]
+    snp_sites = np.flatnonzero(rng.random(length) < 0.02)
+    noise = np.frombuffer(b"NRYn", dtype=np.uint8)
+
+    with open(fasta, "wb") as handle:
+        for sample in range(n_samples):
+            sequence = reference.copy()
+            mutated = snp_sites[rng.random(snp_sites.size) < 0.2]
+            sequence[mutated] = nucleotides[rng.integers(0, 4, mutated.size)]
+            masked = rng.integers(0, length, length // 2000)
+            sequence[masked] = noise[rng.integers(0, noise.size, masked.size)]
+            for gap_start in rng.integers(0, length, 3):
+                sequence[gap_start:gap_start + 30] = ord("-")
+            handle.write(b">sample_%d\n" % sample + sequence.tobytes() + b"\n")
+
+    gene_lengths = rng.integers(300, 1500, length // 300 + 1)
+    ends = np.cumsum(gene_lengths)
+    ends = np.append(ends[ends < length], length)
+    with open(embl, "w") as handle:
+        handle.write(f"ID   Genome standard; DNA; PRO; {length} BP.\nXX\n"
+                     "FH   Key             Location/Qualifiers\nFH\n")
+        start = 1
+        for gene, end in enumerate(ends.tolist()):
+            handle.write(f"FT   feature         {start}..{end}\n"
+                         f"FT                   /label=group_{gene}\n"
+                         f"FT                   /locus_tag=group_{gene}\n")
+            start = end + 1
+        handle.write(f"XX\nSQ   Sequence {length} BP; 0 A; 0 C; 0 G; 0 T; 0 other;\n//\n")
+
+
+def run_measured(command: list) -> tuple:
+    """Runs command and returns (wall time in s, peak RSS in MB) of the child."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    assert process.returncode == 0, stderr.decode()
+    return wall_time, usage.ru_maxrss / 1024
+
+
+def sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@pytest.fixture(scope="module")
+def baseline(request):
+    data = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    data.setdefault("thresholds", dict(DEFAULT_THRESHOLDS))
+    data.setdefault("runs", {})
+    yield data
+    if request.config.getoption("update_baseline"):
+        BASELINE.write_text(json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="module")
+def datasets(tmp_path_factory):
+    """Generates each scale once per session."""
+    cache = {}
+
+    def get(scale):
+        if scale not in cache:
+            directory = tmp_path_factory.mktemp(scale)
+            fasta, embl = directory / "core_gene_alignment.aln", directory / "core_alignment_header.embl"
+            generate_core_alignment(fasta, embl, *SCALES[scale])
+            cache[scale] = (fasta, embl)
+        return cache[scale]
+
+    return get
+
+
+@pytest.mark.parametrize("mode", list(MODES))
+@pytest.mark.parametrize("scale", list(SCALES))
+def test_benchmark(scale, mode, datasets, baseline, tmp_path, request):
+    requested = request.config.getoption("benchmark_scales")
+    check_metrics = requested is not None
+    requested = requested or "smoke"
+    if requested != "all" and scale not in [name.strip() for name in requested.split(",")]:
+        pytest.skip(f"scale {scale} not requested, use --benchmark-scales")
+
+    fasta, embl = datasets(scale)
+    outputs = {"fasta": tmp_path / "alignment_SNPs.fasta", "partition": tmp_path / "partition.txt"}
+    command = [sys.executable, str(SCRIPT), "--input_fasta", str(fasta), "--input_fasta_annotation", str(embl),
+               "--model", "GTR+G", "--max_gap", "30",
+               "--output_fasta", str(outputs["fasta"]), "--output_partition", str(outputs["partition"])]
+    command += [argument.format(tmp=tmp_path) for argument in MODES[mode]]
+
+    wall_time, peak_rss = run_measured(command)
+    measured = {"wall_time_s": round(wall_time, 3), "peak_rss_mb": round(peak_rss, 1),
+                **{f"{name}_sha256": sha256(path) for name, path in outputs.items()}}
+    key = f"{scale}-{mode}"
+    print(f"{key}: {measured}")
+
+    if request.config.getoption("update_baseline"):
+        baseline["runs"][key] = measured
+        return
+    if key not in baseline["runs"]:
+        pytest.skip(f"no baseline for {key}, record one with --update-baseline")
+
+    expected = baseline["runs"][key]
+    for name in outputs:
+        assert measured[f"{name}_sha256"] == expected[f"{name}_sha256"], f"{name} output changed for {key}"
+    if not check_metrics:
+        return
+    thresholds = baseline["thresholds"]
+    wall_limit = max(expected["wall_time_s"] * (1 + thresholds["wall_time_s"]),
+                     expected["wall_time_s"] + MIN_WALL_TIME_SLACK_S)
+    assert measured["wall_time_s"] <= wall_limit, \
+        f"wall time regressed for {key}: {measured['wall_time_s']} s > {wall_limit:.2f} s"
+    rss_limit = expected["peak_rss_mb"] * (1 + thresholds["peak_rss_mb"])
+    assert measured["peak_rss_mb"] <= rss_limit, \
+        f"peak RSS regressed for {key}: {measured['peak_rss_mb']} MB > {rss_limit:.1f} MB"
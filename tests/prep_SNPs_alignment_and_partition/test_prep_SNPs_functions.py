@@ -0,0 +1,218 @@
+"""
+Unit tests for bin/prep_SNPs_alignment_and_partition.py on a small hand-made alignment.
+"""
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from Bio import SeqIO
+from click.testing import CliRunner
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "bin"))
+import prep_SNPs_alignment_and_partition as prep  # noqa: E402
+
+# alignment columns (top to bottom = samples s0..s4), genes g1 = columns 1-6 and g2 = columns 7-12
+COLUMNS = ["aaaaa", "ccccc", "aaaac", "aaccc", "aaccc", "ggggt",
+           "ttttt", "aacct", "aacct", "aacct", "aaaac", "aaaan"]
+GENES = [("g1", 1, 6), ("g2", 7, 12)]
+
+
+@pytest.fixture
+def toy_inputs(tmp_path):
+    fasta, embl = tmp_path / "core.aln", tmp_path / "core.embl"
+    rows = ["".join(column[sample] for column in COLUMNS) for sample in range(len(COLUMNS[0]))]
+    fasta.write_text("".join(f">s{sample}\n{row}\n" for sample, row in enumerate(rows)))
+    lines = [f"ID   Genome standard; DNA; PRO; {len(COLUMNS)} BP.\n", "FH   Key             Location/Qualifiers\n"]
+    for name, start, end in GENES:
+        lines += [f"FT   feature         {start}..{end}\n", f"FT                   /label={name}\n"]
+    embl.write_text("".join(lines) + f"SQ   Sequence {len(COLUMNS)} BP;\n//\n")
+    return fasta, embl
+
+
+def run_main(fasta, embl, tmp_path, *options):
+    """Runs the script in-process and returns (SNP FASTA rows, partition lines, weights or None)."""
+    outputs = {"fasta": tmp_path / "snps.fasta", "partition": tmp_path / "partition.txt",
+               "weights": tmp_path / "weights.txt"}
+    arguments = ["--input_fasta", str(fasta), "--input_fasta_annotation", str(embl), "--model", "GTR+G",
+                 "--max_gap", "50", "--output_fasta", str(outputs["fasta"]),
+                 "--output_partition", str(outputs["partition"])]
+    if "--compress_patterns" in options:
+        arguments += ["--output_weights", str(outputs["weights"])]
+    result = CliRunner().invoke(prep.main, arguments + list(options), catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    rows = outputs["fasta"].read_text().splitlines()[1::2]
+    partition = outputs["partition"].read_text().splitlines()
+    weights = [int(w) for w in outputs["weights"].read_text().split()] if outputs["weights"].exists() else None
+    return rows, partition, weights
+
+
+def output_columns(rows):
+    return ["".join(row[i] for row in rows) for i in range(len(rows[0]))] if rows else []
+
+
+def test_parsimony_informative_sites(toy_inputs):
+    _, matrix = prep.read_alignment(str(toy_inputs[0]))
+    counts, _ = prep.count_sites(matrix)
+    expected = [column in ("aaccc", "aacct") for column in COLUMNS]
+    np.testing.assert_array_equal(prep.parsimony_informative_sites(counts), expected)
+
+
+def test_fold_into_constant(toy_inputs):
+    _, matrix = prep.read_alignment(str(toy_inputs[0]))
+    counts, other_kinds = prep.count_sites(matrix)
+    variable, _, constant = prep.classify_sites(counts, other_kinds)
+    dropped = variable & ~prep.parsimony_informative_sites(counts)
+    folded = prep.fold_into_constant(constant, counts, dropped)
+
+    # singletons count as constant sites of their majority base, the input is left untouched
+    np.testing.assert_array_equal(np.flatnonzero(dropped), [2, 5, 10])
+    np.testing.assert_array_equal(folded[[2, 5, 10]], [prep.A, prep.G, prep.A])
+    assert (constant[[2, 5, 10]] == -1).all()
+    assert prep.constant_site_counts(folded) == [3, 1, 1, 1]
+
+
+@pytest.mark.parametrize("merge_genes,expected_partition", [
+    (False, ["GTR+G+ASC_STAM{2/1/1/0}, g1=1-2", "GTR+G+ASC_STAM{1/0/0/1}, g2=3-5"]),
+    (True, ["GTR+G+ASC_STAM{3/1/1/1}, full_genome=1-5"]),
+])
+def test_informative_only_partition(toy_inputs, tmp_path, merge_genes, expected_partition):
+    options = ["--informative_only"] + (["--merge_genes"] if merge_genes else [])
+    rows, partition, _ = run_main(*toy_inputs, tmp_path, *options)
+    assert output_columns(rows) == ["aaccc", "aaccc", "aacct", "aacct", "aacct"]
+    assert partition == expected_partition
+
+
+@pytest.mark.parametrize("merge_genes,expected_columns,expected_weights,expected_partition", [
+    (False, ["aaaac", "aaccc", "ggggt", "aacct", "aaaac"], [1, 2, 1, 3, 1],
+     ["GTR+G+ASC_STAM{1/1/0/0}, g1=1-3", "GTR+G+ASC_STAM{0/0/0/1}, g2=4-5"]),
+    # patterns are shared across genes once all columns form a single partition
+    (True, ["aaaac", "aaccc", "ggggt", "aacct"], [2, 2, 1, 3],
+     ["GTR+G+ASC_STAM{1/1/0/1}, full_genome=1-4"]),
+])
+def test_compress_patterns_weights(toy_inputs, tmp_path, merge_genes, expected_columns, expected_weights,
+                                   expected_partition):
+    options = ["--compress_patterns"] + (["--merge_genes"] if merge_genes else [])
+    rows, partition, weights = run_main(*toy_inputs, tmp_path, *options)
+    (tmp_path / "uncompressed").mkdir()
+    uncompressed_rows, _, _ = run_main(*toy_inputs, tmp_path / "uncompressed",
+                                       *(["--merge_genes"] if merge_genes else []))
+
+    # one weight per output column, in output order, summing to the number of variable sites
+    assert output_columns(rows) == expected_columns
+    assert weights == expected_weights
+    assert sum(weights) == len(output_columns(uncompressed_rows)) == 8
+    assert partition == expected_partition
+
+
+def cache_entries(cache_dir):
+    return sorted(entry.name for entry in os.scandir(cache_dir))
+
+
+@pytest.mark.parametrize("changed_option", [
+    ["--model", "HKY+G"], ["--max_gap", "40"], ["--merge_genes"], ["--output_site_map", "site_map.tsv"],
+])
+def test_cache_key_follows_options(toy_inputs, tmp_path, changed_option):
+    cache_dir = tmp_path / "cache"
+    first, _, _ = run_main(*toy_inputs, tmp_path, "--cache_dir", str(cache_dir))
+    [key] = cache_entries(cache_dir)
+
+    # an identical run is a hit and reproduces the outputs without adding an entry
+    (tmp_path / "snps.fasta").unlink()
+    assert run_main(*toy_inputs, tmp_path, "--cache_dir", str(cache_dir))[0] == first
+    assert cache_entries(cache_dir) == [key]
+
+    if changed_option[0] == "--output_site_map":
+        changed_option = [changed_option[0], str(tmp_path / changed_option[1])]
+    run_main(*toy_inputs, tmp_path, "--cache_dir", str(cache_dir), *changed_option)
+    assert len(cache_entries(cache_dir)) == 2
+
+
+def test_cache_key_follows_input_content(toy_inputs):
+    fasta, embl = toy_inputs
+    key = prep.input_fingerprint([str(fasta), str(embl)], {"model": "GTR+G"})
+    assert prep.input_fingerprint([str(fasta), str(embl)], {"model": "GTR+G"}) == key
+    fasta.write_text(fasta.read_text().replace("aaaaa", "aaaac", 1))
+    assert prep.input_fingerprint([str(fasta), str(embl)], {"model": "GTR+G"}) != key
+
+
+def test_fetch_from_cache_hit_and_miss(tmp_path):
+    cache_dir, output = str(tmp_path / "cache"), tmp_path / "output.txt"
+    output.write_text("cached")
+    assert not prep.fetch_from_cache(cache_dir, "key", {"output.txt": str(output)})
+
+    prep.store_in_cache(cache_dir, "key", {"output.txt": str(output)}, max_bytes=1 << 20)
+    output.unlink()
+    assert prep.fetch_from_cache(cache_dir, "key", {"output.txt": str(output)})
+    assert output.read_text() == "cached"
+    # an entry without every requested output is a miss
+    assert not prep.fetch_from_cache(cache_dir, "key", {"output.txt": str(output), "other.txt": str(output)})
+
+
+def test_fetch_from_cache_survives_concurrent_eviction(tmp_path, monkeypatch):
+    cache_dir, output = str(tmp_path / "cache"), tmp_path / "output.txt"
+    output.write_text("cached")
+    prep.store_in_cache(cache_dir, "key", {"output.txt": str(output)}, max_bytes=1 << 20)
+
+    copyfile = shutil.copyfile
+
+    def evicted_before_copy(source, destination):
+        prep.evict_cache(cache_dir, 0)
+        return copyfile(source, destination)
+
+    monkeypatch.setattr(prep.shutil, "copyfile", evicted_before_copy)
+    assert not prep.fetch_from_cache(cache_dir, "key", {"output.txt": str(output)})
+
+
+def test_evict_cache_removes_least_recently_used(tmp_path):
+    cache_dir, output = str(tmp_path / "cache"), tmp_path / "output.txt"
+    output.write_bytes(b"x" * 100)
+    for age, key in enumerate(["new", "used", "old"]):
+        prep.store_in_cache(cache_dir, key, {"output.txt": str(output)}, max_bytes=1 << 20)
+        os.utime(os.path.join(cache_dir, key), (1000 - age, 1000 - age))
+    # fetching marks an entry as recently used
+    assert prep.fetch_from_cache(cache_dir, "used", {"output.txt": str(tmp_path / "copy.txt")})
+
+    prep.evict_cache(cache_dir, 250)
+    assert cache_entries(cache_dir) == ["new", "used"]
+    prep.evict_cache(cache_dir, 100)
+    assert cache_entries(cache_dir) == ["used"]
+
+
+def test_store_in_cache_keeps_existing_entry(tmp_path):
+    cache_dir, output = str(tmp_path / "cache"), tmp_path / "output.txt"
+    output.write_text("first")
+    prep.store_in_cache(cache_dir, "key", {"output.txt": str(output)}, max_bytes=1 << 20)
+    output.write_text("second")
+    prep.store_in_cache(cache_dir, "key", {"output.txt": str(output)}, max_bytes=1 << 20)
+
+    # the staging directory of the second run is removed, the stored entry is unchanged
+    assert cache_entries(cache_dir) == ["key"]
+    assert (tmp_path / "cache" / "key" / "output.txt").read_text() == "first"
+
+
+@pytest.mark.parametrize("options", [[], ["--compress_patterns"], ["--compress_patterns", "--merge_genes"]])
+def test_site_map_matches_snp_columns(toy_inputs, tmp_path, options):
+    site_map_path = tmp_path / "site_map.npy"
+    rows, _, _ = run_main(*toy_inputs, tmp_path, "--output_site_map", str(site_map_path), *options)
+    site_map = np.load(site_map_path, mmap_mode="r")
+
+    assert isinstance(site_map, np.memmap)
+    assert len(site_map) == len(output_columns(rows))
+    gene_of = {position: name for name, start, end in GENES for position in range(start, end + 1)}
+    for column, (position, gene, reference) in zip(output_columns(rows), site_map.tolist()):
+        assert COLUMNS[position - 1] == column
+        assert gene == gene_of[position]
+        assert reference.decode() == column[0]
+
+
+def test_read_embl_features_matches_biopython():
+    """Simple, complement, multi-line join and partial locations, and a /note holding digits."""
+    embl = Path(__file__).resolve().parent / "features.embl"
+    expected = [(feature.qualifiers["label"][0], int(feature.location.start), int(feature.location.end))
+                for feature in SeqIO.read(embl, "embl").features]
+    assert prep.read_embl_features(str(embl)).tolist() == expected
+    assert [name for name, _, _ in expected] == ["simple_gene", "reverse_gene", "joined_gene",
+                                                 "partial_start", "partial_end"]
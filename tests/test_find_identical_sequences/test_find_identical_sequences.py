@@ -1,10 +1,14 @@
 import os
+import random
 
 import pytest
 from Bio import SeqIO
 
-from find_identical_sequences import find_identical_sequences
+from find_identical_sequences import find_identical_sequences, stream_identical_sequences
 from find_identical_sequences import write_identical_sequences, write_unique_fasta
+from find_identical_sequences import cluster_by_threshold, identity_upper_bound, seq_identity, sequence_sketch
+from find_identical_sequences import cluster_aligned_by_threshold, IdentityCache, PAIRWISE_SCHEME, make_aligner
+from find_identical_sequences import pairwise_scheme, IdentityWorkers
 
 
 @pytest.fixture
@@ -28,6 +32,29 @@ def test_find_identical_sequences_file(filename, expected_values):
     assert sorted(sorted_result) == sorted(expected)
 
 
+@pytest.mark.parametrize("filename", test_cases)
+def test_stream_identical_sequences_file(filename, expected_values, tmp_path):
+    fasta_path = os.path.join(os.path.dirname(__file__), "test_fasta", filename)
+    unique_path = tmp_path / "unique.fasta"
+    clusters = stream_identical_sequences(fasta_path, unique_path)
+
+    records = list(SeqIO.parse(fasta_path, "fasta"))
+    assert sorted(sorted(group) for group in clusters if len(group) > 1) == sorted(expected_values[filename])
+    assert sorted(record_id for group in clusters for record_id in group) == sorted(r.id for r in records)
+    assert [r.id for r in SeqIO.parse(unique_path, "fasta")] == [group[0] for group in clusters]
+
+
+def test_stream_identical_sequences_order(tmp_path):
+    fasta_path = tmp_path / "input.fasta"
+    fasta_path.write_text(">b\nACGT\n>a\nTTTT\n>c\nacgt\n>d\nGGGG\n>e\nTTTT\n")
+    unique_path = tmp_path / "unique.fasta"
+
+    # first-seen sequence represents its cluster, clusters follow the FASTA order
+    assert stream_identical_sequences(str(fasta_path), unique_path) == [["b", "c"], ["a", "e"], ["d"]]
+    assert [(r.id, str(r.seq)) for r in SeqIO.parse(unique_path, "fasta")] == \
+        [("b", "ACGT"), ("a", "TTTT"), ("d", "GGGG")]
+
+
 @pytest.mark.parametrize("test_case", test_cases)
 def test_write_identical_sequences(test_case, expected_values, tmp_path):
     groups = expected_values[test_case]
@@ -75,3 +102,156 @@ def test_write_unique_fasta(test_case, expected_values, tmp_path):
         assert len(records) == 1
         assert "id1" in ids
         assert "id2" not in ids
+
+
+def _mutated(rng, seq, rate):
+    out = []
+    for base in seq:
+        r = rng.random()
+        if r < rate * 0.8:
+            out.append(rng.choice("ACGTN"))
+        elif r < rate * 0.9:
+            continue
+        elif r < rate:
+            out.extend([base, rng.choice("ACGT")])
+        else:
+            out.append(base)
+    return "".join(out)
+
+
+@pytest.fixture
+def mutant_fasta(tmp_path):
+    """FASTA of 25 random mutants of 3 founder sequences; returns (path, sequences)."""
+    rng = random.Random(1)
+    founders = ["".join(rng.choice("ACGT") for _ in range(300)) for _ in range(3)]
+    seqs = [_mutated(rng, rng.choice(founders), rng.choice([0.0, 0.005, 0.02])) for _ in range(25)]
+    fasta_path = tmp_path / "input.fasta"
+    fasta_path.write_text("".join(f">s{i}\n{seq}\n" for i, seq in enumerate(seqs)))
+    return str(fasta_path), seqs
+
+
+def _exact_identity(aligner, a, b):
+    return aligner.score(a, b) / max(len(a), len(b))
+
+
+def _swapped(rng, seq, n_swaps):
+    out = list(seq)
+    for _ in range(n_swaps):
+        i = rng.randrange(len(out) - 1)
+        out[i], out[i + 1] = out[i + 1], out[i]
+    return "".join(out)
+
+
+def test_seq_identity_scores_longest_common_subsequence():
+    assert seq_identity("ACGT", "AGCT") == 0.75
+    assert seq_identity("AAAA", "AAAAAAAA") == 0.5
+    assert seq_identity("acgt", "ACGT") == 1.0
+
+
+def test_identity_upper_bound_never_below_exact_identity():
+    rng = random.Random(0)
+    aligner = make_aligner()
+    for _ in range(500):
+        a = "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 80)))
+        b = _mutated(rng, a, rng.choice([0.0, 0.02, 0.1, 0.5])) or "A"
+        bound = identity_upper_bound(sequence_sketch(a), sequence_sketch(b))
+        assert bound >= _exact_identity(aligner, a, b)
+
+
+def test_identity_upper_bound_with_adjacent_swaps():
+    rng = random.Random(2)
+    aligner = make_aligner()
+    for _ in range(100):
+        a = "".join(rng.choice("ACGT") for _ in range(rng.randint(50, 400)))
+        b = _swapped(rng, a, rng.randint(1, 10))
+        bound = identity_upper_bound(sequence_sketch(a), sequence_sketch(b))
+        assert bound >= _exact_identity(aligner, a, b)
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+@pytest.mark.parametrize("threshold", [0.9, 0.97, 0.995])
+def test_cluster_by_threshold_matches_exhaustive_greedy(threshold, cpus, mutant_fasta):
+    fasta_path, seqs = mutant_fasta
+    aligner = make_aligner()
+    expected = []
+    reps = []
+    for i, seq in enumerate(seqs):
+        for idx, rep in enumerate(reps):
+            if _exact_identity(aligner, seq, rep) >= threshold:
+                expected[idx].append(f"s{i}")
+                break
+        else:
+            reps.append(seq)
+            expected.append([f"s{i}"])
+
+    assert cluster_by_threshold(fasta_path, threshold, cpus) == expected
+
+
+def test_identity_workers_report_a_dead_worker():
+    workers = IdentityWorkers(2)
+    try:
+        for seq in ["ACGT", "ACGA", "TTTT"]:
+            workers.add_representative(seq)
+        assert workers.first_passing("ACGA", [0, 1, 2], 0.9) == 1
+        workers.workers[0].kill()
+        workers.workers[0].join()
+        with pytest.raises(RuntimeError, match="exited"):
+            workers.first_passing("TTTT", [0, 1, 2], 0.9)
+    finally:
+        workers.close()
+
+
+@pytest.mark.parametrize("n_handling,gap_handling,expected", [
+    ("ignore", "mismatch", [["r1", "r2"], ["r3"], ["r4"]]),
+    ("mismatch", "mismatch", [["r1"], ["r2"], ["r3"], ["r4"]]),
+    ("ignore", "ignore", [["r1", "r2", "r3"], ["r4"]]),
+])
+def test_cluster_aligned_by_threshold(n_handling, gap_handling, expected, tmp_path):
+    fasta_path = tmp_path / "aligned.fasta"
+    fasta_path.write_text(">r1\nACGTACGTAC\n"
+                          ">r2\nACGTNNGTAC\n"
+                          ">r3\nACGT--GTAC\n"
+                          ">r4\nTTTTACGTAC\n")
+    clusters = cluster_aligned_by_threshold(str(fasta_path), 0.9, n_handling, gap_handling)
+    assert clusters == expected
+
+
+def test_identity_cache_reuses_identities_between_runs(mutant_fasta, tmp_path):
+    fasta_path, _ = mutant_fasta
+    expected = cluster_by_threshold(fasta_path, 0.98)
+
+    cache_path = str(tmp_path / "identities.sqlite")
+    first = IdentityCache(cache_path, PAIRWISE_SCHEME, max_entries=1000)
+    assert cluster_by_threshold(fasta_path, 0.98, cache=first) == expected
+    first.close()
+    assert first.misses > 0
+
+    second = IdentityCache(cache_path, PAIRWISE_SCHEME, max_entries=2)
+    assert cluster_by_threshold(fasta_path, 0.98, cache=second) == expected
+    second.close()
+    assert second.misses == 0 and second.hits == first.hits + first.misses
+
+    evicted = IdentityCache(cache_path, PAIRWISE_SCHEME, max_entries=2)
+    assert evicted.connection.execute("SELECT COUNT(*) FROM identities").fetchone()[0] == 2
+    evicted.close()
+
+
+def test_identity_cache_shared_by_concurrent_runs(mutant_fasta, tmp_path):
+    fasta_path, _ = mutant_fasta
+    cache_path = str(tmp_path / "identities.sqlite")
+    first = IdentityCache(cache_path, PAIRWISE_SCHEME, max_entries=1000)
+    second = IdentityCache(cache_path, PAIRWISE_SCHEME, max_entries=1000)
+    expected = cluster_by_threshold(fasta_path, 0.98, cache=first)
+    # the first run is still open, its identities are already committed
+    assert cluster_by_threshold(fasta_path, 0.98, cache=second) == expected
+    assert second.misses == 0
+    second.close()
+    first.close()
+
+
+def test_pairwise_scheme_follows_aligner_scores():
+    aligner = make_aligner()
+    assert pairwise_scheme(aligner) == PAIRWISE_SCHEME
+    assert "mode=global" in PAIRWISE_SCHEME
+    aligner.gap_score = -1.0
+    assert pairwise_scheme(aligner) != PAIRWISE_SCHEME